@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Stand-In Duplicity
+
+Installed as duplicity on the PATH by suite.py. Each invocation is recorded as
+a line of JSON in the file named by EMBALM_BENCH_RECORD, giving the arguments,
+the start time and the elapsed time.
+
+If EMBALM_BENCH_DUPLICITY names the real duplicity, it is run after the
+invocation is recorded. Otherwise just enough of duplicity is imitated for
+embalm to work against a file:// destination:
+
+    full, incremental: adds a backup set to <dest>.sets and writes the
+        statistics to the log file
+    collection-status: lists the backup sets
+    list-current-files: prints <dest>.listing, which is written by suite.py
+    restore: creates the requested files
+"""
+
+# Imports {{{1
+import json
+import os
+import sys
+import time
+
+# Globals {{{1
+RECORD = os.environ.get('EMBALM_BENCH_RECORD')
+REAL_DUPLICITY = os.environ.get('EMBALM_BENCH_DUPLICITY')
+
+# get_option() {{{1
+def get_option(args, name):
+    try:
+        return args[args.index(name) + 1]
+    except (ValueError, IndexError):
+        return None
+
+# destination() {{{1
+def destination(args):
+    "Returns the path of the first file:// URL in the arguments."
+    for arg in args:
+        if arg.startswith('file://'):
+            return arg[len('file://'):]
+    sys.exit('stand-in duplicity only supports file:// destinations.')
+
+# backup() {{{1
+def backup(action, args):
+    dest = destination(args)
+    os.makedirs(dest, exist_ok=True)
+    kind = 'Full' if action == 'full' else 'Incremental'
+    with open(f'{dest}.sets', 'a') as f:
+        f.write(f'{kind} {time.time()}\n')
+    log_file = get_option(args, '--log-file')
+    if log_file:
+        with open(log_file, 'a') as f:
+            f.write('NOTICE 2 1 0\n. Processed volume 1\n')
+            f.write('\n'.join([
+                'NOTICE 1',
+                '. --------------[ Backup Statistics ]--------------',
+                '. ElapsedTime 0.01 (0.01 seconds)',
+                '. TotalDestinationSizeChange 0 (0 bytes)',
+                '. Errors 0',
+                '. -------------------------------------------------',
+                ''
+            ]))
+
+# collection_status() {{{1
+def collection_status(args):
+    dest = destination(args)
+    try:
+        with open(f'{dest}.sets') as f:
+            sets = [line.split() for line in f]
+    except FileNotFoundError:
+        print('No backup chains with active signatures found')
+        return
+    print('Found primary backup chain with matching signature chain:')
+    print('-------------------------')
+    print(f'Chain start time: {time.ctime(float(sets[0][1]))}')
+    print(f'Chain end time: {time.ctime(float(sets[-1][1]))}')
+    print(f'Number of contained backup sets: {len(sets)}')
+    print(f'Total number of contained volumes: {len(sets)}')
+    print(' Type of backup set:                            Time:      Num volumes:')
+    for kind, when in sets:
+        print(f'{kind:>20s}         {time.ctime(float(when))}                 1')
+    print('-------------------------')
+
+# list_current_files() {{{1
+def list_current_files(args):
+    dest = destination(args)
+    with open(f'{dest}.listing') as f:
+        sys.stdout.write(f.read())
+
+# restore() {{{1
+def restore(args):
+    target = args[-1]
+    path = get_option(args, '--file-to-restore')
+    if path:
+        files = [target]
+    else:
+        files = [args[i+1] for i, a in enumerate(args) if a == '--include']
+    for each in files:
+        os.makedirs(os.path.dirname(each) or '.', exist_ok=True)
+        with open(each, 'w') as f:
+            f.write('restored by stand-in duplicity\n')
+
+# main {{{1
+def main():
+    args = sys.argv[1:]
+    start = time.time()
+    status = 0
+    if REAL_DUPLICITY:
+        if RECORD:
+            # record before exec, elapsed time is not known
+            with open(RECORD, 'a') as f:
+                f.write(json.dumps(dict(args=args, start=start)) + '\n')
+        os.execv(REAL_DUPLICITY, [REAL_DUPLICITY] + args)
+    try:
+        action = args[0] if args else None
+        if action in ('full', 'incremental', 'incr', 'inc'):
+            backup(action, args)
+        elif action == 'collection-status':
+            collection_status(args)
+        elif action == 'list-current-files':
+            list_current_files(args)
+        elif action == 'restore':
+            restore(args)
+    except OSError as e:
+        sys.stderr.write(f'stand-in duplicity: {e}\n')
+        status = 1
+    if RECORD:
+        with open(RECORD, 'a') as f:
+            f.write(json.dumps(
+                dict(args=args, start=start, elapsed=time.time()-start)
+            ) + '\n')
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
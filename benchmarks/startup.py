@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Embalm Start-Up Latency
+
+Runs embalm commands repeatedly, each in a fresh Python process, and reports
+the median and minimum wall-clock time of each. The time taken to start a bare
+Python interpreter is given for reference.
+
+Usage:
+    startup.py [options] [<command>...]
+
+Options:
+    -r <num>, --repeat <num>      number of times to run each command [default: 10]
+    -c <cfg>, --config <cfg>      configuration to use
+    -o <file>, --output <file>    save results to file as JSON
+    -b <file>, --baseline <file>  compare to results saved earlier with --output
+    -t <pct>, --tolerance <pct>   allowed slow down relative to baseline, in
+                                  percent [default: 20]
+
+If no commands are given, version, due, info, config and settings are timed.
+The exit status is 1 if any command is slower than the baseline by more than
+the tolerance.
+"""
+
+# Imports {{{1
+from docopt import docopt
+from inform import Error, display, fatal, os_error, output, terminate, warn
+from statistics import median
+import json
+import subprocess
+import sys
+import time
+
+# Globals {{{1
+COMMANDS = 'version due info config settings'.split()
+
+# time_command() {{{1
+def time_command(cmd, repeat):
+    "Run command repeatedly, returning the elapsed times in milliseconds."
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run(
+            cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            universal_newlines=True
+        )
+        times.append(1000*(time.perf_counter() - start))
+        if process.returncode:
+            raise Error(process.stderr.strip(), culprit=' '.join(cmd[3:]))
+    return times
+
+# main {{{1
+def main():
+    cmdline = docopt(__doc__)
+    commands = cmdline['<command>'] or COMMANDS
+    repeat = int(cmdline['--repeat'])
+    tolerance = float(cmdline['--tolerance'])
+    embalm = [sys.executable, '-m', 'embalm']
+    if cmdline['--config']:
+        embalm += ['--config', cmdline['--config']]
+
+    results = {}
+    times = time_command([sys.executable, '-c', 'pass'], repeat)
+    results['python'] = dict(median=median(times), min=min(times))
+    for command in commands:
+        times = time_command(embalm + command.split(), repeat)
+        results[command] = dict(median=median(times), min=min(times))
+
+    output(f'{"command":<16s} {"median":>9s} {"min":>9s}')
+    for command, result in results.items():
+        output(
+            f'{command:<16s} {result["median"]:>7.1f}ms {result["min"]:>7.1f}ms'
+        )
+
+    if cmdline['--output']:
+        with open(cmdline['--output'], 'w') as f:
+            json.dump(results, f, indent=4)
+
+    regressions = 0
+    if cmdline['--baseline']:
+        with open(cmdline['--baseline']) as f:
+            baseline = json.load(f)
+        for command, result in results.items():
+            if command not in baseline or command == 'python':
+                continue
+            before = baseline[command]['median']
+            change = 100*(result['median'] - before)/before
+            if change > tolerance:
+                warn(f'{change:.0f}% slower than baseline.', culprit=command)
+                regressions += 1
+            else:
+                display(f'{change:+.0f}% relative to baseline.', culprit=command)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    try:
+        terminate(main())
+    except Error as err:
+        err.terminate()
+    except OSError as err:
+        fatal(os_error(err))
+    except KeyboardInterrupt:
+        display('Terminated by user.')
+        terminate()
@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+"""
+Embalm End-to-End Benchmarks
+
+Generates synthetic source trees, runs embalm's full, incremental, manifest,
+restore and due commands against each, and reports the wall-clock time, peak
+resident set size and number of duplicity runs of each command.
+
+Usage:
+    suite.py [options] [<tree>...]
+
+Options:
+    -r <num>, --repeat <num>      number of times to run each command [default: 3]
+    -s <factor>, --scale <factor> scale the number and size of the generated
+                                  files [default: 1]
+    -d <path>, --duplicity <path> run the given duplicity rather than the
+                                  stand-in
+    -k <dir>, --keep <dir>        build in the given directory and keep it,
+                                  the trees are reused if they exist
+    -o <file>, --output <file>    save results to file as JSON
+    -b <file>, --baseline <file>  compare to results saved earlier with --output
+    -t <pct>, --tolerance <pct>   allowed slow down or growth relative to
+                                  baseline, in percent [default: 25]
+
+The trees are:
+    small     many small files
+    huge      a few huge (sparse) files
+    deep      deeply nested directories
+    excludes  a moderate tree with a large list of excludes
+If no trees are given, all are used.
+
+Embalm is run from this checkout in a scratch home directory with its own
+settings, using the file backend. Unless --duplicity is given, a stand-in
+duplicity (fake_duplicity.py) is placed first on the PATH. Both record each
+invocation, which gives the number of duplicity runs. The peak RSS is the
+largest of embalm and the processes it ran.
+
+The exit status is 1 if any command is slower or larger than the baseline by
+more than the tolerance, or runs duplicity more often.
+"""
+
+# Imports {{{1
+from docopt import docopt
+from inform import (
+    Error, display, fatal, os_error, output, terminate, warn
+)
+from pathlib import Path
+from statistics import median
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+# Globals {{{1
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCHMARKS_DIR.parent
+FAKE_DUPLICITY = BENCHMARKS_DIR / 'fake_duplicity.py'
+COMMANDS = 'full incremental manifest restore due'.split()
+SEED = 42
+
+# Tree generators {{{1
+# Each populates a directory and returns the excludes to use with it.
+
+# small_files() {{{2
+def small_files(root, scale):
+    "Many small files, 100 to a directory."
+    rng = random.Random(SEED)
+    for i in range(int(20_000*scale)):
+        path = root / f'd{i//100:03d}' / f'f{i:05d}.txt'
+        if i % 100 == 0:
+            path.parent.mkdir(parents=True)
+        path.write_bytes(b'x'*rng.randrange(2048))
+    return [str(root / '**' / '*.pyc'), str(root / '**' / '.git')]
+
+# huge_files() {{{2
+def huge_files(root, scale):
+    "A few huge files, made sparse so they are quick to create."
+    root.mkdir(parents=True)
+    for i in range(4):
+        with open(root / f'image{i}.raw', 'wb') as f:
+            f.truncate(int(256*scale*2**20))
+    (root / 'README').write_text('huge files\n')
+    return []
+
+# deep_tree() {{{2
+def deep_tree(root, scale):
+    "Branches of deeply nested directories with a few files at each level."
+    for branch in range(max(int(8*scale), 1)):
+        path = root / f'b{branch}'
+        for level in range(64):
+            path = path / f'l{level:02d}'
+            path.mkdir(parents=True)
+            for i in range(3):
+                (path / f'f{i}.txt').write_text(f'{branch} {level} {i}\n')
+    return [str(root / '**' / 'l63')]
+
+# many_excludes() {{{2
+def many_excludes(root, scale):
+    """A moderate tree with a large list of excludes.
+
+    The excludes mix globs, paths of individual files, directories that cover
+    some of those files, and duplicates, so that they are normalized too.
+    """
+    count = max(int(2000*scale), 1)
+    for i in range(count):
+        path = root / f'd{i % 20:02d}' / f'f{i:05d}.dat'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(f'{i}\n')
+    excludes = []
+    for i in range(count):
+        choice = i % 4
+        if choice == 0:
+            excludes.append(str(root / '**' / f'*.ext{i}'))
+        elif choice == 1:
+            excludes.append(str(root / f'd{i % 20:02d}' / f'f{i:05d}.dat'))
+        elif choice == 2:
+            excludes.append(str(root / f'd{i % 20:02d}' / f'cache{i}'))
+        else:
+            excludes.append(excludes[i//2])
+    excludes.append(str(root / 'd19'))
+    return excludes
+
+TREES = dict(
+    small = small_files,
+    huge = huge_files,
+    deep = deep_tree,
+    excludes = many_excludes,
+)
+
+# write_listing() {{{1
+def write_listing(src_dir, path):
+    "Write the listing the stand-in duplicity gives for list-current-files."
+    lines = []
+    for dirpath, dirnames, filenames in os.walk(src_dir):
+        for name in [''] + dirnames + filenames:
+            entry = Path(dirpath, name)
+            rel = entry.relative_to(src_dir)
+            if name or rel == Path('.'):
+                mtime = time.ctime(entry.lstat().st_mtime)
+                lines.append(f'{mtime} {rel}')
+    path.write_text('\n'.join(lines) + '\n')
+
+# pick_files() {{{1
+def pick_files(src_dir, count=2):
+    """Choose files to restore, relative to the source directory.
+
+    The files are spread across the tree and have distinct names, as embalm
+    will not restore two files of the same name in one command.
+    """
+    by_name = {}
+    for dirpath, dirnames, filenames in os.walk(src_dir):
+        dirnames.sort()
+        for name in sorted(filenames):
+            by_name.setdefault(
+                name, str(Path(dirpath, name).relative_to(src_dir))
+            )
+    found = sorted(by_name.values())
+    return found[:: max(len(found)//count, 1)][:count]
+
+# Sandbox class {{{1
+class Sandbox:
+    "A scratch home directory with the settings and trees for the benchmarks."
+
+    def __init__(self, root, trees, scale, duplicity):
+        self.root = Path(root).resolve()
+        self.trees = trees
+        self.home = self.root / 'home'
+        self.config_dir = self.home / '.config' / 'embalm'
+        self.dest_dir = self.root / 'dest'
+        self.bin_dir = self.root / 'bin'
+        self.record = self.root / 'duplicity.jsonl'
+        self.env = dict(
+            os.environ,
+            HOME = str(self.home),
+            XDG_CONFIG_HOME = str(self.home / '.config'),
+            XDG_DATA_HOME = str(self.home / '.local' / 'share'),
+            XDG_CACHE_HOME = str(self.home / '.cache'),
+            PATH = f'{self.bin_dir}{os.pathsep}{os.environ["PATH"]}',
+            PYTHONPATH = os.pathsep.join(
+                [str(REPO_DIR)] + os.environ.get('PYTHONPATH', '').split(os.pathsep)
+            ).rstrip(os.pathsep),
+            EMBALM_BENCH_RECORD = str(self.record),
+        )
+        if duplicity:
+            self.env['EMBALM_BENCH_DUPLICITY'] = str(Path(duplicity).resolve())
+        self.build(scale)
+
+    # build() {{{2
+    def build(self, scale):
+        for directory in (self.config_dir, self.dest_dir, self.bin_dir):
+            directory.mkdir(parents=True, exist_ok=True)
+        duplicity = self.bin_dir / 'duplicity'
+        if not duplicity.exists():
+            duplicity.symlink_to(FAKE_DUPLICITY)
+
+        self.excludes = {}
+        for tree in self.trees:
+            src_dir = self.src_dir(tree)
+            excludes_file = self.root / f'{tree}.excludes'
+            if src_dir.exists() and excludes_file.exists():
+                display('reusing tree:', tree)
+                self.excludes[tree] = json.loads(excludes_file.read_text())
+                continue
+            display('generating tree:', tree)
+            start = time.perf_counter()
+            self.excludes[tree] = TREES[tree](src_dir, scale)
+            excludes_file.write_text(json.dumps(self.excludes[tree]))
+            write_listing(src_dir, self.dest_dir / f'{tree}.listing')
+            display(f'    took {time.perf_counter() - start:.1f}s')
+
+        (self.config_dir / 'settings').write_text('\n'.join([
+            f'configuration_files = {" ".join(self.trees)!r}',
+            f'default_configuration = {self.trees[0]!r}',
+            f'gpg_passphrase = "benchmark"',
+            f'backend = "file"',
+            f'ssh_backend_method = "protocol"',
+            f'dest_dir = "{self.dest_dir}/{{config_name}}"',
+            ''
+        ]))
+        for tree in self.trees:
+            (self.config_dir / tree).write_text('\n'.join([
+                f'src_dir = {str(self.src_dir(tree))!r}',
+                f'excludes = {self.excludes[tree]!r}',
+                ''
+            ]))
+
+    # src_dir() {{{2
+    def src_dir(self, tree):
+        return self.root / 'src' / tree
+
+    # modify() {{{2
+    def modify(self, tree):
+        "Change a file in the tree so the next incremental backup is not skipped."
+        path = self.src_dir(tree) / 'changed'
+        path.write_text(f'{time.time()}\n')
+
+    # duplicity_runs() {{{2
+    def duplicity_runs(self):
+        try:
+            with open(self.record) as f:
+                return sum(1 for line in f)
+        except FileNotFoundError:
+            return 0
+
+    # run() {{{2
+    def run(self, tree, command):
+        """Run an embalm command.
+
+        Returns the wall-clock time in milliseconds, the peak RSS in MB, the
+        CPU time in milliseconds and the number of duplicity runs.
+        """
+        cmd = [sys.executable, '-m', 'embalm', '--config', tree] + command
+        runs = self.duplicity_runs()
+        with tempfile.TemporaryFile() as stderr:
+            start = time.perf_counter()
+            process = subprocess.Popen(
+                cmd, cwd=self.src_dir(tree), env=self.env,
+                stdout=subprocess.DEVNULL, stderr=stderr
+            )
+            pid, status, usage = os.wait4(process.pid, 0)
+            elapsed = 1000*(time.perf_counter() - start)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            if process.returncode:
+                stderr.seek(0)
+                raise Error(
+                    stderr.read().decode(errors='replace').strip(),
+                    culprit=(tree, command[0])
+                )
+        return dict(
+            wall = elapsed,
+            rss = usage.ru_maxrss/1024,
+                # ru_maxrss is in kilobytes on Linux
+            cpu = 1000*(usage.ru_utime + usage.ru_stime),
+            duplicity = self.duplicity_runs() - runs,
+        )
+
+# benchmark() {{{1
+def benchmark(sandbox, repeat):
+    "Run each command on each tree, returns the results keyed by tree and command."
+    results = {}
+    for tree in sandbox.trees:
+        restore = pick_files(sandbox.src_dir(tree))
+        for command in COMMANDS:
+            args = [command] + (restore if command == 'restore' else [])
+            measurements = []
+            for i in range(repeat):
+                if command == 'incremental':
+                    # otherwise the backup is skipped as nothing has changed
+                    sandbox.modify(tree)
+                measurements.append(sandbox.run(tree, args))
+            walls = [m['wall'] for m in measurements]
+            results[f'{tree} {command}'] = dict(
+                median = median(walls),
+                min = min(walls),
+                rss = max(m['rss'] for m in measurements),
+                cpu = median(m['cpu'] for m in measurements),
+                duplicity = max(m['duplicity'] for m in measurements),
+            )
+    return results
+
+# compare() {{{1
+def compare(results, baseline, tolerance):
+    "Report changes relative to baseline, returns the number of regressions."
+    regressions = 0
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]
+        problems = []
+        changes = []
+        for key, label in [('median', 'time'), ('rss', 'RSS')]:
+            change = 100*(result[key] - before[key])/before[key]
+            changes.append(f'{label} {change:+.0f}%')
+            if change > tolerance:
+                problems.append(f'{label} {change:.0f}% larger than baseline')
+        if result['duplicity'] > before['duplicity']:
+            problems.append(
+                f'duplicity run {result["duplicity"]} times, '
+                f'{before["duplicity"]} in baseline'
+            )
+        if problems:
+            warn(*problems, sep='; ', culprit=name)
+            regressions += 1
+        else:
+            display(', '.join(changes) + ' relative to baseline.', culprit=name)
+    return regressions
+
+# main {{{1
+def main():
+    cmdline = docopt(__doc__)
+    trees = cmdline['<tree>'] or list(TREES)
+    for tree in trees:
+        if tree not in TREES:
+            raise Error(
+                'unknown tree, choose from:', ', '.join(TREES), culprit=tree
+            )
+    repeat = int(cmdline['--repeat'])
+    scale = float(cmdline['--scale'])
+    tolerance = float(cmdline['--tolerance'])
+
+    if cmdline['--keep']:
+        sandbox = Sandbox(cmdline['--keep'], trees, scale, cmdline['--duplicity'])
+        results = benchmark(sandbox, repeat)
+    else:
+        with tempfile.TemporaryDirectory(prefix='embalm-bench-') as root:
+            sandbox = Sandbox(root, trees, scale, cmdline['--duplicity'])
+            results = benchmark(sandbox, repeat)
+
+    output(
+        f'{"tree":<9s} {"command":<12s} {"median":>9s} {"min":>9s}'
+        f' {"peak RSS":>9s} {"CPU":>9s} {"duplicity":>9s}'
+    )
+    for name, result in results.items():
+        tree, command = name.split()
+        output(
+            f'{tree:<9s} {command:<12s} {result["median"]:>7.1f}ms'
+            f' {result["min"]:>7.1f}ms {result["rss"]:>7.1f}MB'
+            f' {result["cpu"]:>7.1f}ms {result["duplicity"]:>9d}'
+        )
+
+    if cmdline['--output']:
+        with open(cmdline['--output'], 'w') as f:
+            json.dump(dict(
+                python = sys.version.split()[0],
+                duplicity = cmdline['--duplicity'] or 'stand-in',
+                scale = scale,
+                repeat = repeat,
+                results = results,
+            ), f, indent=4)
+
+    regressions = 0
+    if cmdline['--baseline']:
+        with open(cmdline['--baseline']) as f:
+            baseline = json.load(f)
+        if baseline.get('scale') != scale:
+            warn('baseline was run at a different scale.')
+        regressions = compare(results, baseline['results'], tolerance)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    try:
+        terminate(main())
+    except Error as err:
+        err.terminate()
+    except OSError as err:
+        fatal(os_error(err))
+    except KeyboardInterrupt:
+        display('Terminated by user.')
+        terminate()
@@ -0,0 +1,287 @@
+# Passphrase Agent
+#
+# A short-lived process that holds passphrases in memory so that a batch of
+# embalm commands, such as those run with --all or several run in quick
+# succession, only need to unlock Avendesora once. It listens on a Unix domain
+# socket in a directory that is only accessible to the user, and only answers
+# processes run by the same user. Each passphrase is forgotten after
+# passphrase_ttl seconds, and the agent exits once it holds none. The
+# passphrases are never written to disk.
+
+# License {{{1
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+
+# Imports {{{1
+from .preferences import AGENT_SOCKET, PROGRAM_NAME
+from inform import Error, narrate, os_error, warn
+import json
+import os
+import socket
+import struct
+import sys
+import tempfile
+import time
+
+# Globals {{{1
+START_TIMEOUT = 5
+    # seconds to wait for a new agent to start listening
+IDLE_TIMEOUT = 30
+    # seconds a new agent waits for a passphrase before exiting
+TIMEOUT = 5
+    # seconds to wait for the agent to respond
+
+# agent_dir() {{{1
+def agent_dir():
+    """The directory that holds the socket, accessible only to the user.
+
+    The user's runtime directory is used if available, as it is private to the
+    user and is removed when they log out.
+    """
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:
+        path = os.path.join(runtime, PROGRAM_NAME)
+    else:
+        path = os.path.join(tempfile.gettempdir(), f'{PROGRAM_NAME}-{os.getuid()}')
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(path)
+    if info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise Error(
+            'not private to user, passphrase agent will not be used.',
+            culprit=path
+        )
+    return path
+
+# PassphraseAgent class {{{1
+class PassphraseAgent:
+    "Client for the passphrase agent, starting it when needed."
+
+    def __init__(self):
+        directory = agent_dir()
+        self.socket = os.path.join(directory, AGENT_SOCKET)
+        self.lockfile = os.path.join(directory, f'{AGENT_SOCKET}.lock')
+        self.lock_fd = None
+
+    # request() {{{2
+    def request(self, **message):
+        "Send a request, returns the response or None if no agent is running."
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(TIMEOUT)
+            try:
+                sock.connect(self.socket)
+                sock.sendall(json.dumps(message).encode() + b'\n')
+                with sock.makefile('rb') as f:
+                    response = f.readline()
+            except OSError:
+                # not running, or exited while answering
+                return None
+        if not response:
+            return None
+        return json.loads(response)
+
+    # get() {{{2
+    def get(self, key):
+        response = self.request(op='get', key=key)
+        return response.get('value') if response else None
+
+    # put() {{{2
+    def put(self, key, value, ttl):
+        if self.request(op='put', key=key, value=value, ttl=ttl) is None:
+            self.start()
+            self.request(op='put', key=key, value=value, ttl=ttl)
+
+    # status() {{{2
+    def status(self):
+        """Returns the number of passphrases held and when the last expires.
+
+        Returns None if the agent is not running.
+        """
+        response = self.request(op='status')
+        return (response['count'], response['expires']) if response else None
+
+    # stop() {{{2
+    def stop(self):
+        "Forget the passphrases and stop, returns False if not running."
+        return self.request(op='stop') is not None
+
+    # start() {{{2
+    def start(self):
+        import subprocess
+        narrate('starting passphrase agent.')
+        subprocess.Popen(
+            [sys.executable, '-m', 'embalm.agent', self.socket],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL, start_new_session=True
+        )
+        deadline = time.time() + START_TIMEOUT
+        while time.time() < deadline:
+            if self.request(op='status') is not None:
+                return
+            time.sleep(0.05)
+        raise Error('passphrase agent did not start.', culprit=self.socket)
+
+    # lock() {{{2
+    def lock(self):
+        "Serialize access so that only one process unlocks a passphrase."
+        import fcntl
+        self.lock_fd = os.open(self.lockfile, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+        except OSError:
+            self.unlock()
+            raise
+
+    # unlock() {{{2
+    def unlock(self):
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+            self.lock_fd = None
+
+# fetch() {{{1
+def fetch(key, ttl, get):
+    """Get a passphrase from the agent.
+
+    If the agent does not hold it, it is found by calling get(key) and given
+    to the agent to hold for ttl seconds. If the agent cannot be used, get(key)
+    is returned.
+    """
+    try:
+        agent = PassphraseAgent()
+        agent.lock()
+    except (Error, OSError) as err:
+        unavailable(err)
+        return get(key)
+
+    # errors from get() are not caught, they are not due to the agent
+    try:
+        try:
+            value = agent.get(key)
+        except (Error, OSError, ValueError) as err:
+            unavailable(err)
+            value = None
+        if value is not None:
+            narrate('passphrase provided by agent.')
+            return value
+        value = get(key)
+        try:
+            agent.put(key, value, ttl)
+        except (Error, OSError, ValueError) as err:
+            unavailable(err)
+        return value
+    finally:
+        agent.unlock()
+
+# unavailable() {{{1
+def unavailable(err):
+    warn(
+        'passphrase agent unavailable.',
+        codicil=os_error(err) if isinstance(err, OSError) else str(err)
+    )
+
+# serve() {{{1
+def serve(path):
+    """Run the agent, listening on path.
+
+    Exits if another agent is already listening.
+    """
+    old_umask = os.umask(0o177)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            server.bind(path)
+        except OSError:
+            # a stale socket from an agent that did not exit cleanly
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+                return
+            except OSError:
+                os.unlink(path)
+                server.bind(path)
+            finally:
+                probe.close()
+    finally:
+        os.umask(old_umask)
+    inode = os.stat(path).st_ino
+    server.listen()
+
+    held = {}
+    deadline = time.time() + IDLE_TIMEOUT
+    try:
+        while True:
+            now = time.time()
+            held = {k: v for k, v in held.items() if v[1] > now}
+            if held:
+                deadline = max(v[1] for v in held.values())
+            if now >= deadline:
+                return
+            server.settimeout(deadline - now)
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                continue
+            with conn:
+                if not respond(conn, held):
+                    return
+    finally:
+        held.clear()
+        try:
+            if os.stat(path).st_ino == inode:
+                os.unlink(path)
+        except OSError:
+            pass
+        server.close()
+
+# respond() {{{1
+def respond(conn, held):
+    "Answer a request, returns False if the agent is to stop."
+    conn.settimeout(TIMEOUT)
+    if hasattr(socket, 'SO_PEERCRED'):
+        creds = conn.getsockopt(
+            socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')
+        )
+        pid, uid, gid = struct.unpack('3i', creds)
+        if uid != os.getuid():
+            return True
+    try:
+        with conn.makefile('rb') as f:
+            request = json.loads(f.readline())
+        op = request.get('op')
+        now = time.time()
+        if op == 'get':
+            value, expires = held.get(request['key'], (None, now))
+            response = dict(value=value if expires > now else None)
+        elif op == 'put':
+            held[request['key']] = (request['value'], now + float(request['ttl']))
+            response = dict(ok=True)
+        elif op == 'status':
+            response = dict(
+                count = len(held),
+                expires = max((e for v, e in held.values()), default=None),
+            )
+        elif op == 'stop':
+            conn.sendall(json.dumps(dict(ok=True)).encode() + b'\n')
+            return False
+        else:
+            response = dict(error='unknown request')
+        conn.sendall(json.dumps(response).encode() + b'\n')
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+    return True
+
+# main {{{1
+if __name__ == '__main__':
+    serve(sys.argv[1])
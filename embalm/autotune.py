@@ -0,0 +1,206 @@
+# Autotune
+#
+# Chooses the duplicity volume size, whether uploads are asynchronous, and the
+# number of concurrent uploads from the throughput measured in previous
+# backups, which are recorded in the run history.
+#
+# The tuner climbs towards the best combination one step at a time. It starts
+# from the combination given by the settings. On each backup it runs the best
+# combination measured so far, unless one of its neighbors (the adjacent
+# volume sizes, the other upload mode, or the adjacent concurrency) has not
+# yet been measured, in which case that neighbor is tried. Once every
+# neighbor of the best has been measured the tuner settles on the best,
+# while continuing to measure it so that it follows changes in the link.
+
+# License {{{1
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+
+# Imports {{{1
+from inform import Error, log, narrate
+from collections import namedtuple
+import statistics
+
+# Globals {{{1
+VOLSIZES = [25, 50, 100, 200, 500, 1000]
+    # volume sizes in MB
+DEFAULT_VOLSIZE = 200
+MIN_BYTES = 10_000_000
+    # runs that sent fewer bytes are dominated by fixed costs
+RECENT_RUNS = 50
+    # number of recent runs considered
+SAMPLES = 3
+    # number of recent measurements of a combination that are averaged
+CPU_BOUND = 0.9
+    # fraction of the elapsed time spent computing above which a run is
+    # considered CPU bound
+Tuning = namedtuple('Tuning', 'volsize asynchronous_upload concurrency')
+
+# Tuner class {{{1
+class Tuner:
+    """Choose the duplicity options that give the best throughput.
+
+    The settings volsize, asynchronous_upload and upload_concurrency give the
+    starting point, and autotune_concurrency gives the largest number of
+    concurrent uploads to try. Autotuning is enabled by the autotune setting;
+    if disabled the settings are used as given.
+    """
+    def __init__(self, settings):
+        self.settings = settings
+        self.enabled = settings.get('autotune', False)
+        try:
+            volsize = int(settings.get('volsize', DEFAULT_VOLSIZE))
+            concurrency = int(settings.get('upload_concurrency', 1))
+            self.max_concurrency = int(
+                settings.get('autotune_concurrency', concurrency)
+            )
+        except (TypeError, ValueError):
+            raise Error(
+                'expected integer.',
+                culprit='volsize, upload_concurrency or autotune_concurrency'
+            )
+        self.initial = Tuning(
+            volsize, bool(settings.get('asynchronous_upload', False)),
+            concurrency
+        )
+        self.volsizes = sorted(set(VOLSIZES) | {volsize})
+        self.concurrencies = sorted(
+            {1, concurrency} | {
+                n for n in (2, 4, 8, 16) if n <= self.max_concurrency
+            }
+        )
+
+    # measurements() {{{2
+    def measurements(self):
+        "Returns the throughput and CPU load of each combination that was tried."
+        from .history import RunHistory, duration
+        settings = self.settings
+        if not settings.history_file.exists():
+            return {}
+        with RunHistory(settings.history_file) as history:
+            runs = history.runs(
+                settings.config_name, kinds=['full', 'incremental']
+            )
+        samples = {}
+        for run in runs[-RECENT_RUNS:]:
+            seconds = duration(run)
+            if (
+                run.status or run.volsize is None or seconds <= 0
+                or (run.bytes_sent or 0) < MIN_BYTES
+            ):
+                continue
+            tuning = Tuning(
+                int(run.volsize), bool(run.asynchronous_upload),
+                int(run.concurrency or 1)
+            )
+            load = (run.cpu_seconds or 0)/seconds
+            samples.setdefault(tuning, []).append(
+                (run.bytes_sent/seconds, load)
+            )
+        return {
+            tuning: (
+                statistics.mean(r for r, l in values[-SAMPLES:]),
+                statistics.mean(l for r, l in values[-SAMPLES:]),
+            )
+            for tuning, values in samples.items()
+        }
+
+    # neighbors() {{{2
+    def neighbors(self, tuning, cpu_bound):
+        """The combinations that differ from tuning by one step.
+
+        When CPU bound, larger volumes and more concurrent uploads do not help,
+        so only the upload mode and smaller steps are considered.
+        """
+        neighbors = []
+        i = self.volsizes.index(tuning.volsize)
+        for j in (i - 1, i + 1):
+            if 0 <= j < len(self.volsizes) and not (cpu_bound and j > i):
+                neighbors.append(tuning._replace(volsize=self.volsizes[j]))
+        neighbors.append(
+            tuning._replace(asynchronous_upload=not tuning.asynchronous_upload)
+        )
+        if tuning.concurrency in self.concurrencies:
+            i = self.concurrencies.index(tuning.concurrency)
+            for j in (i - 1, i + 1):
+                if 0 <= j < len(self.concurrencies) and not (cpu_bound and j > i):
+                    neighbors.append(
+                        tuning._replace(concurrency=self.concurrencies[j])
+                    )
+        return neighbors
+
+    # choose() {{{2
+    def choose(self):
+        "Returns the combination to use for the next backup."
+        if not self.enabled:
+            return self.initial
+        measured = self.measurements()
+        if not measured:
+            reason = 'no measurements yet, starting from settings'
+            tuning = self.initial
+        else:
+            best = max(measured, key=lambda t: measured[t][0])
+            rate, load = measured[best]
+            cpu_bound = load > CPU_BOUND
+            untried = [
+                n for n in self.neighbors(best, cpu_bound) if n not in measured
+            ]
+            if untried:
+                tuning = untried[0]
+                reason = (
+                    f'best so far is {render(best)} at {rate/1e6:.2f} MB/s'
+                    f'{" (CPU bound)" if cpu_bound else ""}, trying neighbor'
+                )
+            else:
+                tuning = best
+                reason = (
+                    f'best of {len(measured)} measured at {rate/1e6:.2f} MB/s'
+                    f'{" (CPU bound)" if cpu_bound else ""}'
+                )
+        narrate(f'autotune: {render(tuning)}.')
+        log(f'autotune chose {render(tuning)}: {reason}.')
+        return tuning
+
+    # options() {{{2
+    def options(self, tuning):
+        """Duplicity options for a combination.
+
+        When not autotuning, the volume size is only given if specified in
+        the settings, otherwise duplicity's default is used.
+        """
+        args = []
+        if self.enabled or self.settings.get('volsize'):
+            args.extend(['--volsize', str(tuning.volsize)])
+        if tuning.asynchronous_upload:
+            args.append('--asynchronous-upload')
+        if tuning.concurrency > 1:
+            args.extend(['--concurrency', str(tuning.concurrency)])
+        return args
+
+    # values() {{{2
+    def values(self, tuning):
+        "Values to be recorded in the run history."
+        specified = self.enabled or self.settings.get('volsize')
+        return dict(
+            volsize = tuning.volsize if specified else None,
+            asynchronous_upload = tuning.asynchronous_upload,
+            concurrency = tuning.concurrency,
+        )
+
+# render() {{{1
+def render(tuning):
+    return ', '.join([
+        f'volsize {tuning.volsize} MB',
+        'asynchronous' if tuning.asynchronous_upload else 'synchronous',
+        f'concurrency {tuning.concurrency}',
+    ])
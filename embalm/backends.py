@@ -0,0 +1,149 @@
+# Backends
+#
+# Each backend knows how to build the duplicity URL for the destination and
+# which duplicity options it requires. The backend is chosen with the backend
+# setting:
+#
+#     sftp: the default, duplicity's pexpect sftp backend, sftp://
+#     rsync: rsync over ssh, rsync://
+#     file: a local directory, such as a mounted NAS or a second disk, file://
+#
+# The file backend needs no server, so backups run at the speed of the disk
+# and the whole of embalm can be exercised without a server.
+
+# License {{{1
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+
+# Imports {{{1
+from inform import Error
+from shlib import to_path
+import shlex
+
+# Globals {{{1
+DEFAULT_BACKEND = 'sftp'
+
+# Backend base class {{{1
+class Backend:
+    REQUIRED = []
+        # settings that must be given when using this backend
+    REMOTE = True
+        # destination is on another host, reached using dest_server
+
+    def __init__(self, settings):
+        self.settings = settings
+
+    @classmethod
+    def backends(cls):
+        for backend in cls.__subclasses__():
+            yield backend
+            yield from backend.backends()
+
+    def check(self):
+        "Returns the names of any settings required by the backend that are missing."
+        return [n for n in self.REQUIRED if not self.settings.get(n)]
+
+    def options(self, bw_limit=None):
+        "Duplicity options needed by the backend, bw_limit is in kbps."
+        return []
+
+    def describe(self):
+        "Describes the destination for people."
+        settings = self.settings
+        return f'{settings.dest_server}:{settings.dest_dir}'
+
+# SFTP backend {{{1
+class SFTPBackend(Backend):
+    NAME = 'sftp'
+    REQUIRED = ['dest_server', 'ssh_backend_method']
+
+    def check(self):
+        missing = super().check()
+        method = self.settings.ssh_backend_method
+        if not missing and method not in ['option', 'protocol']:
+            self.settings.fail(
+                f'{method}:', 'invalid value given for ssh_backend_method.',
+            )
+        return missing
+
+    def url(self):
+        settings = self.settings
+        if settings.ssh_backend_method == 'option':
+            protocol = 'sftp'
+        else:
+            protocol = 'pexpect+sftp'
+        dest_server = settings.value('dest_server')
+        dest_dir = settings.value('dest_dir')
+        return f'{protocol}://{dest_server}/{dest_dir}'
+
+    def options(self, bw_limit=None):
+        settings = self.settings
+        args = []
+        if settings.ssh_backend_method == 'option':
+            args.extend('--ssh-backend pexpect'.split())
+        command = ['sftp'] + settings.get_ssh_options()
+            # don't add -v option, it hopelessly confuses pexpect
+        ssh_identity = settings.value('ssh_identity')
+        if ssh_identity:
+            command.extend(['-i', str(to_path(ssh_identity))])
+        if bw_limit:
+            command.extend(['-l', f'{bw_limit:.0f}'])
+        args.extend(['--sftp-command', ' '.join(shlex.quote(a) for a in command)])
+        return args
+
+# Rsync backend {{{1
+class RsyncBackend(Backend):
+    NAME = 'rsync'
+    REQUIRED = ['dest_server']
+
+    def url(self):
+        settings = self.settings
+        dest_server = settings.value('dest_server')
+        dest_dir = settings.value('dest_dir')
+        return f'rsync://{dest_server}/{dest_dir}'
+
+    def options(self, bw_limit=None):
+        settings = self.settings
+        ssh = ['ssh'] + settings.get_ssh_options()
+        ssh_identity = settings.value('ssh_identity')
+        if ssh_identity:
+            ssh.extend(['-i', str(to_path(ssh_identity))])
+        rsync = []
+        if len(ssh) > 1:
+            rsync.extend(['-e', ' '.join(shlex.quote(a) for a in ssh)])
+        if bw_limit:
+            # rsync takes its limit in kilobytes per second
+            rsync.append(f'--bwlimit={max(bw_limit/8, 1):.0f}')
+        if not rsync:
+            return []
+        return ['--rsync-options', ' '.join(shlex.quote(a) for a in rsync)]
+
+# File backend {{{1
+class FileBackend(Backend):
+    NAME = 'file'
+    REMOTE = False
+
+    def url(self):
+        return f'file://{to_path(self.settings.value("dest_dir")).resolve()}'
+
+    def describe(self):
+        return str(to_path(self.settings.value('dest_dir')))
+
+# get_backend() {{{1
+def get_backend(settings):
+    name = settings.get('backend') or DEFAULT_BACKEND
+    for backend in Backend.backends():
+        if backend.NAME == name:
+            return backend(settings)
+    known = ', '.join(b.NAME for b in Backend.backends())
+    raise Error(f'unknown backend, choose from {known}.', culprit=('backend', name))
@@ -0,0 +1,229 @@
+# Bandwidth
+#
+# Determines the bandwidth limit to use when running duplicity. The limit may
+# be fixed (bw_limit), may vary with the time of day and day of week
+# (bw_schedule), or may be chosen adaptively from the throughput measured in
+# recent backups.
+#
+# A schedule maps time windows to limits, for example:
+#
+#     bw_schedule = {
+#         'Mon-Fri 08:00-18:00': '2 Mbit',
+#         'Sat,Sun 10-16': 'adaptive',
+#     }
+#
+# Outside of the windows bw_limit is used. Limits are given in kbps unless
+# units are given, 0, None and 'unlimited' indicate no limit, and 'adaptive'
+# indicates that a fraction (bw_adaptive_fraction) of the throughput that was
+# measured in recent backups that were not held back by a limit should be
+# used.
+
+# License {{{1
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+
+# Imports {{{1
+from inform import Error, is_str, narrate
+from collections import namedtuple
+from datetime import datetime, timedelta
+import re
+
+# Globals {{{1
+DAYS = 'mon tue wed thu fri sat sun'.split()
+WINDOW = re.compile(
+    r'(?:(?P<days>[a-z,-]+)\s+)?'
+    r'(?P<start>\d\d?(?::\d\d)?)\s*-\s*(?P<end>\d\d?(?::\d\d)?)',
+    re.I
+)
+LIMIT = re.compile(r'([\d.]+)\s*((?i:[kmg])?)(bit/s|bit|bps|b/s|B/s|Bps|B)?')
+    # b is bits and B is bytes, the prefixes are not case sensitive
+UNIT_SCALE = {'': 1, 'k': 1, 'm': 1000, 'g': 1000000}
+    # a number without units is in kbps
+BYTE_UNITS = {'B/s', 'Bps', 'B'}
+ADAPTIVE = 'adaptive'
+ADAPTIVE_FRACTION = 0.5
+ADAPTIVE_RUNS = 10
+    # number of recent unlimited runs from which the throughput is estimated
+CAPPED = 0.9
+    # runs whose throughput is within this fraction of their limit are assumed
+    # to have been held back by the limit
+Window = namedtuple('Window', 'days start end limit')
+
+# parse_limit() {{{1
+def parse_limit(value, culprit):
+    "Convert a limit to kbps, returns None for no limit."
+    if value in (None, 0, ''):
+        return None
+    if is_str(value):
+        value = value.strip()
+        if value.lower() == 'unlimited':
+            return None
+        if value.lower() == ADAPTIVE:
+            return ADAPTIVE
+        match = LIMIT.fullmatch(value)
+        if not match:
+            raise Error('invalid bandwidth limit.', culprit=culprit)
+        number, prefix, unit = match.groups()
+        scale = UNIT_SCALE[prefix.lower()] if prefix or not unit else 0.001
+        if unit in BYTE_UNITS:
+            scale *= 8
+        return float(number)*scale or None
+    try:
+        return float(value) or None
+    except (TypeError, ValueError):
+        raise Error('invalid bandwidth limit.', culprit=culprit)
+
+# parse_minutes() {{{1
+def parse_minutes(text):
+    "Convert HH or HH:MM to minutes since midnight."
+    hours, _, minutes = text.partition(':')
+    return 60*int(hours) + int(minutes or 0)
+
+# parse_days() {{{1
+def parse_days(text, culprit):
+    "Convert a list of days or day ranges (Mon-Fri,Sun) to a set of weekdays."
+    if not text:
+        return set(range(7))
+    days = set()
+    for each in text.lower().split(','):
+        first, _, last = each.partition('-')
+        try:
+            first = DAYS.index(first[:3])
+            last = DAYS.index(last[:3]) if last else first
+        except ValueError:
+            raise Error('invalid day.', culprit=culprit)
+        day = first
+        days.add(day)
+        while day != last:
+            day = (day + 1) % 7
+            days.add(day)
+    return days
+
+# parse_schedule() {{{1
+def parse_schedule(schedule):
+    "Convert a bw_schedule setting to a list of Windows."
+    if not schedule:
+        return []
+    if not hasattr(schedule, 'items'):
+        raise Error('expected a dictionary.', culprit='bw_schedule')
+    windows = []
+    for spec, limit in schedule.items():
+        culprit = ('bw_schedule', spec)
+        match = WINDOW.fullmatch(spec.strip())
+        if not match:
+            raise Error('invalid time window.', culprit=culprit)
+        windows.append(Window(
+            parse_days(match.group('days'), culprit),
+            parse_minutes(match.group('start')),
+            parse_minutes(match.group('end')),
+            parse_limit(limit, culprit),
+        ))
+    return windows
+
+# Bandwidth class {{{1
+class Bandwidth:
+    """The bandwidth limit of a configuration.
+
+    The run history is used to estimate the throughput for adaptive limits.
+    """
+    def __init__(self, settings):
+        self.settings = settings
+        self.default = parse_limit(settings.get('bw_limit'), 'bw_limit')
+        self.windows = parse_schedule(settings.get('bw_schedule'))
+        self.fraction = float(
+            settings.get('bw_adaptive_fraction', ADAPTIVE_FRACTION)
+        )
+
+    # scheduled() {{{2
+    def scheduled(self, when):
+        "The limit given by the schedule at a particular time."
+        minutes = 60*when.hour + when.minute
+        weekday = when.weekday()
+        for window in self.windows:
+            if window.start <= window.end:
+                if weekday in window.days and window.start <= minutes < window.end:
+                    return window.limit
+            else:
+                # window wraps past midnight, it belongs to the day it starts
+                if weekday in window.days and minutes >= window.start:
+                    return window.limit
+                if (weekday - 1) % 7 in window.days and minutes < window.end:
+                    return window.limit
+        return self.default
+
+    # boundaries() {{{2
+    def boundaries(self, now):
+        "The times during the coming week at which a window starts or ends."
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        times = set()
+        for day in range(8):
+            for window in self.windows:
+                for minutes in (window.start, window.end):
+                    times.add(midnight + timedelta(days=day, minutes=minutes))
+        return sorted(t for t in times if t > now)
+
+    # adaptive() {{{2
+    def adaptive(self):
+        """Estimate the limit from the throughput of recent runs.
+
+        Only runs whose throughput was not held back by a limit are used, as
+        the throughput of the others shows only the limit. These are the
+        most recent such runs however far back they go, so the estimate is
+        kept while the adaptive limit holds back the runs that follow.
+        Returns None if there are no such runs.
+        """
+        from .history import RunHistory, throughput
+        settings = self.settings
+        if not settings.history_file.exists():
+            return None
+        with RunHistory(settings.history_file) as history:
+            runs = history.runs(
+                settings.config_name, kinds=['full', 'incremental']
+            )
+        rates = []
+        for run in reversed(runs):
+            rate = throughput(run)
+            if run.status or run.skipped or not rate:
+                continue
+            rate = 8*rate/1000
+            if run.bw_limit and rate >= CAPPED*run.bw_limit:
+                continue
+            rates.append(rate)
+            if len(rates) == ADAPTIVE_RUNS:
+                break
+        if not rates:
+            return None
+        rates.sort()
+        return self.fraction*rates[len(rates)//2]
+
+    # limit() {{{2
+    def limit(self, now=None):
+        """The limit in kbps and the time it next changes.
+
+        The limit is None if there is no limit, and the time is None if the
+        limit never changes.
+        """
+        now = now or datetime.now()
+        limit = self.scheduled(now)
+        change = None
+        for boundary in self.boundaries(now):
+            if self.scheduled(boundary) != limit:
+                change = boundary
+                break
+        if limit == ADAPTIVE:
+            limit = self.adaptive()
+            narrate(
+                'adaptive bandwidth limit:',
+                f'{limit:.0f} kbps.' if limit else 'unknown, using no limit.'
+            )
+        return limit, change
@@ -3,7 +3,9 @@
 # Provides common interface for dictionaries and lists. If a string is passed
 # in, it is split and then treated as a list. Optimized for convenience rather
 # than for large collections. Sorting versus the key is used to avoid randomness
-# in the ordering of the dictionary-based collections.
+# in the ordering of the dictionary-based collections. FrozenCollection is
+# a read-only variant for large collections; it sorts once and supports fast
+# membership tests.
 
 # License {{{1
 # This program is free software: you can redistribute it and/or modify
@@ -64,3 +66,51 @@ class Collection(object):
 
     def __getitem__(self, key):
         return self.collection[key]
+
+
+# FrozenCollection {{{1
+class FrozenCollection(Collection):
+    """Read-only collection.
+
+    The items are copied once when the collection is created and every
+    accessor is served from the copy, with a set of the values kept for
+    membership tests. Changes made to the underlying dictionary or list after
+    the collection is created are not seen.
+    """
+    def __init__(self, collection, splitter=None):
+        super().__init__(collection, splitter)
+        self._items = tuple(super().items())
+        self._keys = tuple(k for k, v in self._items)
+        self._values = tuple(v for k, v in self._items)
+        if hasattr(self.collection, 'keys'):
+            self._lookup = dict(self._items)
+        else:
+            self._lookup = self._values
+        try:
+            self._members = frozenset(self._values)
+        except TypeError:
+            # values are not hashable
+            self._members = None
+
+    def keys(self):
+        return self._keys
+
+    def values(self):
+        return self._values
+
+    def items(self):
+        return self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, key):
+        return self._lookup[key]
+
+    def __contains__(self, item):
+        if self._members is not None:
+            try:
+                return item in self._members
+            except TypeError:
+                return False
+        return item in self._values
@@ -21,21 +21,31 @@ from .preferences import (
     DEFAULT_COMMAND,
     DUPLICITY_LOG_FILE,
     KNOWN_SETTINGS,
+    PROGRAM_NAME,
     RESTORE_DIR,
+    RESTORE_STAGING_DIR,
+    SCAN_JOBS,
+)
+from .utilities import (
+    disk_usage, incr_date_files, parse_time, read_statistics, render_command,
+    two_columns
 )
-from .utilities import two_columns, render_command
 from inform import (
     Color, Error,
-    cull, display, full_stop, indent, narrate, output, render, warn,
+    cull, display, full_stop, indent, narrate, os_error, output, render, warn,
 )
 from docopt import docopt
 from shlib import mkdir, mv, rm, to_path, Run, set_prefs
 set_prefs(use_inform=True, log_cmd=True)
+from contextlib import nullcontext
+from functools import lru_cache
+from datetime import datetime
 from textwrap import dedent, fill
 import arrow
 import os
 import re
 import sys
+import time
 
 
 # Utilities {{{1
@@ -44,34 +54,40 @@ def title(text):
     return full_stop(text.capitalize())
 
 # duplicity_options() {{{2
-def duplicity_options(settings, options):
+def duplicity_options(settings, options, log=True):
     args = []
     gpg_binary = settings.value('gpg_binary')
     if gpg_binary:
         args.extend(['--gpg-binary', str(to_path(gpg_binary))])
-    if DUPLICITY_LOG_FILE:
+    if DUPLICITY_LOG_FILE and log:
         args.extend(f'--log-file {DUPLICITY_LOG_FILE}'.split())
         rm(DUPLICITY_LOG_FILE)
-    if settings.ssh_backend_method == 'option':
-        args.extend('--ssh-backend pexpect'.split())
     args.append('-v9' if 'verbose' in options else '-v8')
     args.append('--dry-run' if 'trial-run' in options else '')
     return cull(args)
 
 # archive_dir_command() {{{2
 def archive_dir_command(settings):
-    return f'--archive-dir {settings.archive_dir} --name {settings.config_name}'.split()
-
-# sftp_command() {{{2
-def sftp_command(settings):
-    command = ['sftp']
-        # don't add -v option, it hopelessly confuses pexpect
-    ssh_identity = settings.value('ssh_identity')
-    if ssh_identity:
-        command.extend(['-i', str(to_path(ssh_identity))])
-    if settings.bw_limit:
-        command.extend(['-l', str(settings.bw_limit)])
-    return ['--sftp-command', ' '.join(command)]
+    return f'--archive-dir {settings.get_archive_dir()} --name {settings.config_name}'.split()
+
+# bandwidth() {{{2
+def bandwidth(settings):
+    "Returns the bandwidth limit in kbps and the time the limit next changes."
+    from .bandwidth import Bandwidth
+    if not settings.backend.REMOTE:
+        return None, None
+    return Bandwidth(settings).limit()
+
+# backend_options() {{{2
+def backend_options(settings, bw_limit=None):
+    """Returns the duplicity options needed by the backend.
+
+    bw_limit is in kbps, 0 indicates no limit.  If not given, the limit
+    currently in effect is used.
+    """
+    if bw_limit is None:
+        bw_limit = bandwidth(settings)[0]
+    return settings.backend.options(bw_limit)
 
 # render() {{{2
 def render_path(path):
@@ -79,49 +95,104 @@ def render_path(path):
 
 # excludes() {{{2
 def excludes(settings):
-    excludes = []
-    for each in settings.values('excludes'):
-        excludes.extend(['--exclude', render_path(each)])
-    return excludes
+    """Write the normalized excludes to a file list and return its options.
 
-# destination() {{{2
-def destination(settings):
+    Duplicity 0.6.25 and lower, which use the 'option' ssh backend method, only
+    support glob patterns in --exclude-globbing-filelist.
+    """
+    from .excludes import write_filelist
+    write_filelist(list(settings.values('excludes')), settings.excludes_file)
     if settings.ssh_backend_method == 'option':
-        protocol = 'sftp'
-    elif settings.ssh_backend_method == 'protocol':
-        protocol = 'pexpect+sftp'
+        option = '--exclude-globbing-filelist'
     else:
-        raise NotImplementedError
-    dest_server = settings.value('dest_server')
-    dest_dir = settings.value('dest_dir')
-    return f'{protocol}://{dest_server}/{dest_dir}'
+        option = '--exclude-filelist'
+    return [option, str(settings.excludes_file)]
+
+# exclude_matcher() {{{2
+def exclude_matcher(settings, write=True):
+    """Matcher for the normalized excludes.
+
+    The normalized excludes are taken from the exclude file list if it is up
+    to date, otherwise the list is written.  If write is False, nothing is
+    written and the excludes are normalized afresh.
+    """
+    from .excludes import normalize, write_filelist
+    from .scanner import ExcludeMatcher
+    patterns = list(settings.values('excludes'))
+    if write:
+        try:
+            return ExcludeMatcher(write_filelist(patterns, settings.excludes_file))
+        except OSError:
+            # the working directory does not exist yet
+            pass
+    return ExcludeMatcher(normalize(patterns)[0])
+
+# scan_jobs() {{{2
+def scan_jobs(settings):
+    "Number of threads used to scan the source directory."
+    jobs = settings.get('scan_jobs', SCAN_JOBS)
+    try:
+        jobs = int(jobs)
+        if jobs < 1:
+            raise ValueError
+    except ValueError:
+        raise Error('expected a positive integer.', culprit='scan_jobs')
+    return jobs
+
+# destination() {{{2
+def destination(settings):
+    return settings.backend.url()
+
+# avendesora_passcode() {{{2
+def avendesora_passcode(account):
+    narrate('running avendesora to access passphrase.')
+    try:
+        from avendesora import PasswordGenerator, PasswordError
+    except ImportError:
+        raise Error(
+            'Avendesora is not available',
+            'you must specify gpg_passphrase in settings.',
+            sep = ', '
+        )
+    try:
+        pw = PasswordGenerator()
+        return str(pw.get_account(account).get_value('passcode'))
+    except PasswordError as err:
+        raise Error(str(err))
+
+# get_passcode() {{{2
+@lru_cache(maxsize=None)
+def get_passcode(account, ttl=None):
+    """Get the passphrase from Avendesora, or from the agent if ttl is given.
+
+    The result is kept for the life of the process as Avendesora is slow and
+    duplicity may be run many times by one command.
+    """
+    if ttl:
+        from .agent import fetch
+        return fetch(account, ttl, avendesora_passcode)
+    return avendesora_passcode(account)
 
 # publish_passcode() {{{2
 def publish_passcode(settings):
     passcode = settings.gpg_passphrase
     if not passcode and settings.avendesora_account:
-        narrate('running avendesora to access passphrase.')
         try:
-            from avendesora import PasswordGenerator, PasswordError
-            pw = PasswordGenerator()
-            account = pw.get_account(settings.value('avendesora_account'))
-            passcode = str(account.get_value('passcode'))
-        except PasswordError as err:
-            settings.fail(err)
-        except ImportError:
-            settings.fail(
-                'Avendesora is not available',
-                'you must specify gpg_passphrase in settings.',
-                sep = ', '
-            )
-    else:
+            ttl = float(settings.get('passphrase_ttl') or 0)
+        except ValueError:
+            settings.fail('passphrase_ttl:', 'expected number.')
+        try:
+            passcode = get_passcode(settings.value('avendesora_account'), ttl)
+        except Error as err:
+            settings.fail(err.get_message())
+    elif not passcode:
         settings.fail('you must specify gpg_passphrase in settings.')
 
     narrate('gpg passphrase is set.')
     return dict(PASSPHRASE = passcode)
 
 # run_duplicity() {{{2
-def run_duplicity(cmd, settings, narrating):
+def run_duplicity(cmd, settings, narrating, capture=False, wait=True):
     os.environ.update(publish_passcode(settings))
     for ssh_var in 'SSH_AGENT_PID SSH_AUTH_SOCK'.split():
         if ssh_var not in os.environ:
@@ -130,11 +201,242 @@ def run_duplicity(cmd, settings, narrating):
                 culprit=ssh_var
             )
     narrate('running:\n{}'.format(indent(render_command(cmd))))
-    modes = 'soeW' if narrating else 'sOEW'
-    Run(cmd, modes=modes, env=os.environ)
+    if not wait:
+        # returns at once, use poll() and wait() on the returned object
+        # the output is not captured as nothing would read it until duplicity
+        # terminates, and duplicity would block once the pipe filled; instead
+        # it is discarded unless narrating, with errors kept in a file
+        import subprocess
+        import tempfile
+        errors = None if narrating else tempfile.TemporaryFile()
+        process = Run(
+            cmd, modes='soew', env=os.environ,
+            stdout=None if narrating else subprocess.DEVNULL, stderr=errors
+        )
+        process.errors = errors
+        return process
+    if capture:
+        modes = 'sOeW'
+    else:
+        modes = 'soeW' if narrating else 'sOEW'
+    return Run(cmd, modes=modes, env=os.environ)
+
+# cpu_time() {{{2
+def cpu_time():
+    "CPU time used by the child processes that have finished, in seconds."
+    import resource
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+# wait_until() {{{2
+def wait_until(process, deadline):
+    """Wait for a process to finish, but no later than deadline.
+
+    deadline is a datetime. process is as returned by run_duplicity() with
+    wait=False. Returns True if the process finished and raises Error if it
+    failed.
+    """
+    while datetime.now() < deadline:
+        if process.poll() is not None:
+            try:
+                process.wait()
+            except Error as err:
+                if process.errors:
+                    process.errors.seek(0)
+                    msg = process.errors.read().decode(errors='replace').strip()
+                    if msg:
+                        raise Error(msg, status=err.status)
+                raise
+            finally:
+                if process.errors:
+                    process.errors.close()
+            return True
+        time.sleep(1)
+    return False
+
+# last_backup_time() {{{2
+def last_backup_time(settings):
+    "Time of the most recent backup in seconds since the epoch, 0 if unknown."
+    try:
+        return arrow.get(settings.incr_date_file.read_text()).timestamp()
+    except (FileNotFoundError, arrow.parser.ParserError):
+        return 0
+
+# read_backup_date() {{{2
+def read_backup_date(path):
+    "Read the date of a backup from a date file."
+    try:
+        return arrow.get(path.read_text())
+    except FileNotFoundError:
+        return arrow.get('19560105', 'YYYYMMDD')
+    except arrow.parser.ParserError:
+        raise Error('date not given in iso format.', culprit=path)
+
+# read_source_state() {{{2
+def read_source_state(settings):
+    "Digest of the source directory as of the last backup, None if unknown."
+    try:
+        match = re.search(
+            r'digest = (\w+)', settings.source_state_file.read_text()
+        )
+        return match.group(1) if match else None
+    except FileNotFoundError:
+        return None
+
+# get_snapshot() {{{2
+def get_snapshot(index, settings, options, date=None, refresh=False):
+    """Find manifest of the backups as they were on a given date.
+
+    The snapshot is taken from the local index if possible, otherwise it is
+    fetched from the remote server with duplicity list-current-files and added
+    to the index.
+
+    A snapshot taken before when may only be used if no backup was made
+    between the two. The last backup is known from the date file, and the
+    earlier ones from the backup sets in the index, provided those were
+    fetched after the last backup. Otherwise only a snapshot taken after the
+    last backup can be used.
+    """
+    when = parse_time(date).timestamp() if date else arrow.now().timestamp()
+    latest = last_backup_time(settings)
+    sets_current = index.sets_fetched() >= latest
+    if not refresh:
+        snapshot = index.find(when)
+        if snapshot and (
+            snapshot.time >= latest
+            or (
+                sets_current
+                and index.last_set(snapshot.time, when) is None
+                and not snapshot.time < latest <= when
+            )
+        ):
+            narrate('using manifest from index.')
+            return snapshot
+
+    # snapshot is missing or stale, get listing from remote
+    narrate('fetching manifest from remote.')
+    cmd = (
+        f'duplicity list-current-files'.split()
+        + duplicity_options(settings, options, log=False)
+        + archive_dir_command(settings)
+        + backend_options(settings)
+        + (['--time', date] if date else [])
+        + [destination(settings)]
+    )
+    listing = run_duplicity(cmd, settings, False, capture=True)
+    if not date:
+        when = latest or when
+    elif sets_current:
+        # key the snapshot to the backup set it shows, if known
+        when = index.last_set(0, when) or when
+    return index.add(when, 'listing', listing.stdout.splitlines())
+
+# index_backup_sets() {{{2
+def index_backup_sets(index, settings, options, refresh=False):
+    """Assure every backup set in the chain has a snapshot in the index.
+
+    The list of backup sets is fetched from the remote using duplicity
+    collection-status if there has been a backup since it was last fetched.
+    Then a listing is fetched for each set that is not yet in the index.
+    """
+    from .index import parse_collection_status
+
+    if refresh or index.sets_fetched() < last_backup_time(settings):
+        narrate('fetching list of backup sets from remote.')
+        cmd = (
+            f'duplicity collection-status'.split()
+            + duplicity_options(settings, options, log=False)
+            + archive_dir_command(settings)
+            + backend_options(settings)
+            + [destination(settings)]
+        )
+        status = run_duplicity(cmd, settings, False, capture=True)
+        index.set_backup_sets(
+            list(parse_collection_status(status.stdout.splitlines())),
+            arrow.now().timestamp()
+        )
+
+    sets = index.backup_sets()
+    ends = [s.time for s in sets[1:]] + [float('inf')]
+    for backup_set, end in zip(sets, ends):
+        if not index.covers(backup_set.time, end):
+            narrate('fetching manifest for backup set:', backup_set.time)
+            cmd = (
+                f'duplicity list-current-files'.split()
+                + duplicity_options(settings, options, log=False)
+                + archive_dir_command(settings)
+                + backend_options(settings)
+                + ['--time', str(int(backup_set.time))]
+                + [destination(settings)]
+            )
+            listing = run_duplicity(cmd, settings, False, capture=True)
+            index.add(
+                backup_set.time, backup_set.kind, listing.stdout.splitlines()
+            )
+
+# index_backup() {{{2
+def index_backup(index, settings, kind, previous, start, when):
+    """Add the snapshot left by a backup that just completed to the index.
+
+    The snapshot is built by applying the paths that duplicity logged as
+    added, changed or deleted to the snapshot of the previous backup, made at
+    previous.  The modification times are taken from the source directory,
+    which is only possible for files that have not changed since duplicity
+    started at start.  If the previous snapshot is not in the index, or a file
+    has changed, nothing is added and the snapshot is fetched from the remote
+    when it is first needed.  Returns the snapshot, or None.
+    """
+    from .progress import LogParser
+    if not DUPLICITY_LOG_FILE:
+        return None
+    base = None
+    if kind != 'full':
+        base = index.find(when)
+        if not base or base.time < previous:
+            narrate('previous backup is not indexed, deferring manifest.')
+            return None
+
+    # the last status logged for each path is the one that counts
+    parser = LogParser()
+    statuses = {}
+    try:
+        with open(DUPLICITY_LOG_FILE, errors='replace') as log:
+            for line in log:
+                for event in parser.feed(line):
+                    if event.kind == 'file':
+                        status, path = event.data
+                        statuses[path] = status
+    except OSError as err:
+        narrate(os_error(err))
+        return None
+
+    changes = []
+    for path, status in statuses.items():
+        if status == 'D':
+            changes.append((path, None))
+            continue
+        try:
+            mtime = os.lstat(os.path.join(str(settings.src_dir), path)).st_mtime
+        except OSError:
+            mtime = None
+        if mtime is None or mtime > start:
+            narrate('source changed during backup, deferring manifest.')
+            return None
+        changes.append((path, int(mtime)))
+    return index.update(
+        base, when, 'full' if base is None else 'incremental', changes
+    )
 
 # Command base class {{{1
 class Command(object):
+    READ_ONLY = False
+        # read-only commands do not create the working directory or open the
+        # logfile, which allows them to start quickly
+    RECORD_RUNS = False
+        # add each run to the run history and write Prometheus metrics if
+        # prometheus_dir is given, run() may return a dictionary of values
+        # particular to the command, such as bytes_sent
+
     @classmethod
     def commands(cls):
         for cmd in cls.__subclasses__():
@@ -161,7 +463,41 @@ class Command(object):
     @classmethod
     def execute(cls, name, args, settings, options):
         narrate('{}:'.format(name))
-        cls.run(name, args if args else [], settings, options)
+        if not cls.RECORD_RUNS:
+            cls.run(name, args if args else [], settings, options)
+            return
+
+        start = time.time()
+        try:
+            values = cls.run(name, args if args else [], settings, options)
+        except (Error, OSError, KeyboardInterrupt) as err:
+            # inform errors return None for attributes they were not given
+            status = getattr(err, 'status', None) or 1
+            cls.record(name, settings, options, start, status)
+            raise
+        cls.record(name, settings, options, start, 0, values)
+
+    @classmethod
+    def record(cls, name, settings, options, start, status, values=None):
+        """Write the metrics and add the run to the history.
+
+        Trial runs are not recorded, as they would report a backup that was
+        not made.
+        """
+        from .history import RunHistory
+        from .metrics import write_metrics
+        if 'trial-run' in options:
+            return
+        values = values or {}
+        write_metrics(settings, name, start, status, values)
+        try:
+            with RunHistory(settings.history_file) as history:
+                history.add(
+                    start, time.time(), name, settings.config_name, status,
+                    values
+                )
+        except Error as err:
+            warn('could not update run history.', codicil=str(err))
 
     @classmethod
     def summarize(cls, width=16):
@@ -188,7 +524,8 @@ class Command(object):
 
 # Backup command group {{{1
 class Backup(Command):
-    REQUIRES_EXCLUSIVITY = True
+    LOCK_MODE = 'exclusive'
+    RECORD_RUNS = True
 
     @classmethod
     def run(cls, command, args, settings, options):
@@ -209,25 +546,117 @@ class Backup(Command):
         for each in settings.values('run_before_backup'):
             narrate('running:', each)
             Run(each, 'SoeW')
-        rm('duplicity.log')
 
-        # run duplicity
-        cmd = (
+        # scan the source directory to determine whether anything has changed
+        # since the last backup
+        source_state = None
+        if settings.get('skip_unchanged', False):
+            from .scanner import scan
+            source_state = scan(
+                settings.src_dir, exclude_matcher(settings),
+                scan_jobs(settings)
+            )
+            unchanged = source_state.digest == read_source_state(settings)
+            if kind == 'incr' and unchanged and not cmdline.get('--force'):
+                display('nothing has changed since last backup, skipping.')
+                # the date of the last backup is left alone as it tells
+                # when the remote last changed
+                if 'trial-run' not in options:
+                    settings.unchanged_date_file.write_text(str(arrow.now()))
+                cls.run_after_backup(settings)
+                return dict(
+                    files=0, bytes_sent=0, volumes=0,
+                    bytes_scanned=source_state.bytes, skipped=True
+                )
+
+        # run duplicity, restarting it whenever the bandwidth limit changes so
+        # the new limit takes effect; duplicity resumes an interrupted backup
+        # from the last volume it completed
+        rm('duplicity.log')
+        from .autotune import Tuner
+        tuner = Tuner(settings)
+        tuning = tuner.choose()
+        leading = (
             f'duplicity {kind}'.split()
             + duplicity_options(settings, options)
+            + tuner.options(tuning)
             + archive_dir_command(settings)
-            + sftp_command(settings)
-            + excludes(settings)
+        )
+        trailing = (
+            excludes(settings)
             + [render_path(settings.src_dir), destination(settings)]
         )
-        run_duplicity(cmd, settings, 'narrate' in options)
+        narrating = 'narrate' in options
+        if DUPLICITY_LOG_FILE:
+            from .progress import Monitor
+            show = not narrating and sys.stderr.isatty()
+            monitor = Monitor(
+                DUPLICITY_LOG_FILE, settings.src_dir, show,
+                tuning.asynchronous_upload
+            )
+        else:
+            monitor = nullcontext()
+        cpu_start = cpu_time()
+        start = time.time()
+        with monitor as progress:
+            while True:
+                bw_limit, change = bandwidth(settings)
+                cmd = leading + backend_options(settings, bw_limit or 0) + trailing
+                if change is None or 'trial-run' in options:
+                    run_duplicity(cmd, settings, narrating)
+                    break
+                narrate(f'bandwidth limit changes at {change:%H:%M}.')
+                process = run_duplicity(cmd, settings, narrating, wait=False)
+                if wait_until(process, change):
+                    break
+                process.process.terminate()
+                process.process.wait()
+                if process.errors:
+                    process.errors.close()
+                display('bandwidth limit changed, restarting duplicity.')
+        values = dict(bw_limit=bw_limit, cpu_seconds=cpu_time() - cpu_start)
+        values.update(tuner.values(tuning))
+        if progress:
+            values.update(files=progress.files, volumes=progress.volume)
+        if source_state:
+            values['bytes_scanned'] = source_state.bytes
+        stats = read_statistics(DUPLICITY_LOG_FILE) if DUPLICITY_LOG_FILE else {}
+        if 'TotalDestinationSizeChange' in stats:
+            values['bytes_sent'] = stats['TotalDestinationSizeChange']
+        if 'ElapsedTime' in stats:
+            values['duplicity_seconds'] = stats['ElapsedTime']
 
         # update the date files
+        previous = last_backup_time(settings)
         now = arrow.now()
         if kind == 'full':
             settings.full_date_file.write_text(str(now))
         settings.incr_date_file.write_text(str(now))
 
+        # record state of the source directory as it was before the backup
+        if source_state and 'trial-run' not in options:
+            settings.source_state_file.write_text(dedent(f"""
+                digest = {source_state.digest}
+                files = {source_state.files}
+                bytes = {source_state.bytes}
+            """).lstrip())
+
+        # record the new backup set in the manifest index
+        if 'trial-run' not in options:
+            from .index import ManifestIndex
+            try:
+                with ManifestIndex(settings.manifest_index) as index:
+                    index_backup(
+                        index, settings, kind, previous, start, now.timestamp()
+                    )
+            except Error as err:
+                warn('could not update manifest index.', codicil=str(err))
+
+        cls.run_after_backup(settings)
+        return values
+
+    @classmethod
+    def run_after_backup(cls, settings):
         # run any scripts specified to be run after a backup
         for each in settings.values('run_after_backup'):
             narrate('running:', each)
@@ -249,7 +678,7 @@ class FullBackup(Backup):
         After that, you should normally prefer incremental backups, though you
         should run a full backup every few months.
     """).strip()
-    REQUIRES_EXCLUSIVITY = True
+    LOCK_MODE = 'exclusive'
 
 
 # Incremental backup command {{{2
@@ -258,12 +687,15 @@ class IncrementalBackup(Backup):
     DESCRIPTION = 'run an incremental backup'
     USAGE = dedent("""
         Usage:
-            embalm incremental
-            embalm incr
-            embalm inc
-            embalm i
+            embalm incremental [--force]
+            embalm incr [--force]
+            embalm inc [--force]
+            embalm i [--force]
             embalm
 
+        Options:
+            -f, --force   run the backup even if nothing has changed
+
         After you have run a full backup, you may run incremental backups, which
         are considerably faster and consume much less space:
 
@@ -274,8 +706,61 @@ class IncrementalBackup(Backup):
             ./embalm
 
         However, it is important to run a full backup every few months.
+
+        If skip_unchanged is True, the source directory is scanned before
+        running duplicity, and if no file or directory has changed since the
+        last backup, the backup is skipped.  The backup is then not reported
+        as overdue unless update_date_when_unchanged is False.  Use --force to
+        run the backup anyway.
     """).strip()
-    REQUIRES_EXCLUSIVITY = True
+    LOCK_MODE = 'exclusive'
+
+
+# Agent command {{{1
+class Agent(Command):
+    NAMES = 'agent',
+    DESCRIPTION = 'show or stop the passphrase agent'
+    USAGE = dedent("""
+        Usage:
+            embalm agent [--stop]
+
+        Options:
+            -s, --stop   forget the passphrases and stop the agent
+
+        If passphrase_ttl is given, the passphrase that is obtained from
+        Avendesora is given to an agent that holds it in memory for that many
+        seconds, so that the commands that follow need not run Avendesora
+        again.  This command shows whether the agent is running and when it
+        will forget the passphrases.
+    """).strip()
+    LOCK_MODE = None
+    READ_ONLY = True
+
+    @classmethod
+    def run(cls, command, args, settings, options):
+        from .agent import PassphraseAgent
+        from .utilities import render_duration
+
+        # read command line
+        cmdline = docopt(cls.USAGE, argv=[command] + args)
+
+        agent = PassphraseAgent()
+        if cmdline['--stop']:
+            if agent.stop():
+                output('passphrase agent stopped.')
+            else:
+                output('passphrase agent is not running.')
+            return
+        status = agent.status()
+        if status is None:
+            output('passphrase agent is not running.')
+            return
+        count, expires = status
+        if count:
+            remaining = render_duration(expires - time.time())
+            output(f'passphrases held: {count}, forgotten in {remaining}.')
+        else:
+            output('passphrase agent is running but holds no passphrases.')
 
 
 # Configs command {{{1
@@ -284,10 +769,11 @@ class Configs(Command):
     DESCRIPTION = 'list available backup configurations'
     USAGE = dedent("""
         Usage:
-            embalm configs
+            embalm config
             embalm c
     """).strip()
-    REQUIRES_EXCLUSIVITY = False
+    LOCK_MODE = None
+    READ_ONLY = True
 
     @classmethod
     def run(cls, command, args, settings, options):
@@ -301,6 +787,51 @@ class Configs(Command):
             output('No configurations available.')
 
 
+# Diff command {{{1
+class Diff(Command):
+    NAMES = 'diff',
+    DESCRIPTION = 'show how the backed up files changed between two dates'
+    USAGE = dedent("""
+        Usage:
+            embalm [options] diff <from> [<to>]
+
+        Options:
+            -r, --refresh              rebuild the manifest index from the remote
+
+        Lists the paths that were added (+), removed (-), or modified (~)
+        between two dates.  If <to> is not given, the most recent backup is
+        used.  For example:
+
+            embalm diff 2024-01-01 3D
+
+        The dates take the same form as the --date option of manifest.  The
+        file lists are taken from the manifest index, and are only fetched
+        from the remote server if they are not available locally.
+    """).strip()
+    LOCK_MODE = 'shared'
+
+    @classmethod
+    def run(cls, command, args, settings, options):
+        # read command line
+        cmdline = docopt(cls.USAGE, argv=[command] + args)
+
+        from .index import ManifestIndex, render_entry
+        with ManifestIndex(settings.manifest_index) as index:
+            if cmdline['--refresh']:
+                index.clear()
+            old = get_snapshot(index, settings, options, cmdline['<from>'])
+            new = get_snapshot(index, settings, options, cmdline['<to>'])
+            counts = {'+': 0, '-': 0, '~': 0}
+            for status, path, mtime in index.compare(old, new):
+                counts[status] += 1
+                output(status, render_entry(path, mtime))
+            narrate(
+                '{} added, {} removed, {} modified.'.format(
+                    counts['+'], counts['-'], counts['~']
+                )
+            )
+
+
 # Due command {{{1
 class Due(Command):
     NAMES = 'due', 'd'
@@ -318,6 +849,13 @@ class Due(Command):
             -D <num>, --full-days <num>  emit message if this many days have passed
                                          since full backup
             -m <msg>, --message <msg>    the message to emit
+            --watch                      keep running, emit new messages when
+                                         they change
+            --interval <secs>            how often to re-evaluate messages when
+                                         watching [default: 60]
+            --i3bar                      when watching, use the i3bar protocol
+            -a, --all                    report on all configurations
+            -j, --json                   report in JSON
 
         If you specify either --inc-days or --full-days or both, the message is printed 
         if the corresponding backup is overdue, otherwise nothing is printed. If both 
@@ -340,14 +878,48 @@ class Due(Command):
 
             > embalm due -D90 -m "It has been {elapsed} since the last {kind} backup."
             It has been 4 months since the last full backup.
+
+        With --watch, embalm stays running and prints a new line each time the
+        messages change, which happens when a backup completes or when the
+        messages are re-evaluated every --interval seconds.  This avoids
+        starting embalm each time the status bar is updated.  The messages are
+        placed on a single line, or with --i3bar they are given as JSON in the
+        i3bar protocol, with overdue backups marked as urgent.  The date files
+        are watched with inotify if the inotify_simple package is installed,
+        otherwise they are checked periodically.
+
+        With --all or --json, a report is given that contains the date and age
+        in seconds of the last incremental and full backups, and whether each
+        is overdue given --inc-days and --full-days.  --all reports on every
+        configuration, all from a single process.  --json gives the report in
+        JSON, otherwise it is given as a table in which overdue backups are
+        marked with *.  For example:
+
+            > embalm due --all --json -d1 -D90
     """).strip()
-    REQUIRES_EXCLUSIVITY = False
+    LOCK_MODE = None
+    READ_ONLY = True
 
     @classmethod
     def run(cls, command, args, settings, options):
         # read command line
         cmdline = docopt(cls.USAGE, argv=[command] + args)
 
+        if cmdline['--watch']:
+            return cls.watch(cmdline, settings)
+        if cmdline['--all'] or cmdline['--json']:
+            return cls.report(cmdline, settings)
+
+        for kind, message, overdue in cls.messages(cmdline, settings):
+            output(message)
+
+    @classmethod
+    def messages(cls, cmdline, settings):
+        """Generate the messages.
+
+        Returns a list of tuples, each containing the kind of backup, the
+        message, and whether the backup is overdue.
+        """
         def gen_message(kind, date):
             if cmdline['--message']:
                 since_last_backup = arrow.now() - date
@@ -359,41 +931,294 @@ class Due(Command):
             else:
                 return f'{kind} backup was performed {date.humanize()}.'
 
+        messages = []
+
         # Get date of last incremental backup and warn user if it is overdue
-        incr_date_file = settings.incr_date_file
-        try:
-            incr_backup_date = arrow.get(incr_date_file.read_text())
-        except FileNotFoundError:
-            incr_backup_date = arrow.get('19560105', 'YYYYMMDD')
-        except arrow.parser.ParserError:
-            fatal('date not given in iso format.', culprit=inc_date_file)
+        incr_backup_date = max(
+            read_backup_date(path) for path in incr_date_files(settings)
+        )
         if cmdline.get('--inc-days'):
             since_last_backup = arrow.now() - incr_backup_date
             days = since_last_backup.total_seconds()/86400
             if days > float(cmdline['--inc-days']):
-                output(gen_message('incremental', incr_backup_date))
+                messages.append(
+                    ('incremental', gen_message('incremental', incr_backup_date), True)
+                )
 
         # Get date of last full backup and warn user if it is overdue
-        full_date_file = settings.full_date_file
-        try:
-            full_backup_date = arrow.get(full_date_file.read_text())
-        except FileNotFoundError:
-            full_backup_date = arrow.get('19560105', 'YYYYMMDD')
-        except arrow.parser.ParserError:
-            fatal('date not given in iso format.', culprit=full_date_file)
+        full_backup_date = read_backup_date(settings.full_date_file)
         if cmdline.get('--full-days'):
             since_last_backup = arrow.now() - full_backup_date
             days = since_last_backup.total_seconds()/86400
             if days > float(cmdline['--full-days']):
-                output(gen_message('full', full_backup_date))
+                messages.append(
+                    ('full', gen_message('full', full_backup_date), True)
+                )
 
         # Don't print a message if limits were imposed and backups are not overdye
         if cmdline.get('--inc-days') or cmdline.get('--full-days'):
-            return
+            return messages
 
         # Otherwise, simply report age of backups
-        output(gen_message('full', full_backup_date))
-        output(gen_message('incremental', incr_backup_date))
+        return [
+            ('full', gen_message('full', full_backup_date), False),
+            ('incremental', gen_message('incremental', incr_backup_date), False),
+        ]
+
+    @classmethod
+    def status(cls, cmdline, settings):
+        "Returns the date, age and whether overdue of each kind of backup."
+        now = arrow.now()
+        status = dict(config=settings.config_name)
+        for kind, date_files, limit in [
+            ('incremental', incr_date_files(settings), cmdline['--inc-days']),
+            ('full', [settings.full_date_file], cmdline['--full-days']),
+        ]:
+            date_files = [path for path in date_files if path.exists()]
+            if date_files:
+                date = max(read_backup_date(path) for path in date_files)
+                age = (now - date).total_seconds()
+                status[kind] = dict(
+                    date=str(date), age=age,
+                    overdue=bool(limit) and age > 86400*float(limit)
+                )
+            else:
+                status[kind] = dict(date=None, age=None, overdue=bool(limit))
+        return status
+
+    @classmethod
+    def report(cls, cmdline, settings):
+        "Report on the status of one or all configurations."
+        import json
+        from .settings import Settings as ConfigSettings
+
+        if cmdline['--all']:
+            report = []
+            for config in Collection(settings.configuration_files):
+                if config == settings.config_name:
+                    report.append(cls.status(cmdline, settings))
+                    continue
+                try:
+                    config_settings = ConfigSettings(config, None, read_only=True)
+                    config_settings.resolve_paths()
+                    report.append(cls.status(cmdline, config_settings))
+                except Error as err:
+                    report.append(dict(config=config, error=str(err)))
+        else:
+            report = [cls.status(cmdline, settings)]
+
+        if cmdline['--json']:
+            output(json.dumps(report, indent=4))
+            return
+
+        def render_age(status):
+            age = 'never' if status['age'] is None else f'{status["age"]:.0f}s'
+            return age + ('*' if status['overdue'] else '')
+
+        output(f'{"config":<20s} {"incremental":>16s} {"full":>16s}')
+        for status in report:
+            if 'error' in status:
+                output(f'{status["config"]:<20s} {status["error"]}')
+            else:
+                output('{:<20s} {:>16s} {:>16s}'.format(
+                    status['config'],
+                    render_age(status['incremental']),
+                    render_age(status['full']),
+                ))
+
+    @classmethod
+    def watch(cls, cmdline, settings):
+        """Print the messages each time they change.
+
+        The messages are re-evaluated when either date file changes and every
+        --interval seconds.  Runs until killed.
+        """
+        import json
+        from .watch import FileWatcher
+
+        interval = float(cmdline['--interval'])
+        i3bar = cmdline['--i3bar']
+        watcher = FileWatcher(
+            incr_date_files(settings) + [settings.full_date_file]
+        )
+        if i3bar:
+            # output() flushes its stream, so each line is seen at once
+            output(json.dumps(dict(version=1)))
+            output('[')
+        previous = None
+        while True:
+            messages = cls.messages(cmdline, settings)
+            if messages != previous:
+                if i3bar:
+                    blocks = [
+                        dict(
+                            name=PROGRAM_NAME, instance=kind,
+                            full_text=message, urgent=overdue
+                        )
+                        for kind, message, overdue in messages
+                    ]
+                    output(json.dumps(blocks) + ',')
+                else:
+                    output(
+                        ' '.join(message for kind, message, overdue in messages)
+                    )
+                previous = messages
+            watcher.wait(interval)
+
+
+# Estimate command {{{1
+class Estimate(Command):
+    NAMES = 'estimate',
+    DESCRIPTION = 'estimate the size and duration of the next backup'
+    USAGE = dedent("""
+        Usage:
+            embalm estimate
+
+        The source directory is scanned locally, with the excludes applied, to
+        find the number of bytes in a full backup and the number of bytes in
+        files modified since the last backup. The duration of each is
+        projected from the bandwidth limit and from the typical throughput of
+        recent backups, as recorded in the run history, whichever is slower. Compression and the rsync deltas used by
+        duplicity are not accounted for, so these are upper bounds.
+    """).strip()
+    LOCK_MODE = None
+    READ_ONLY = True
+
+    @classmethod
+    def run(cls, command, args, settings, options):
+        # read command line
+        docopt(cls.USAGE, argv=[command] + args)
+        from .scanner import scan
+        from .utilities import render_bytes, render_duration
+
+        since = last_backup_time(settings)
+        source = scan(
+            settings.src_dir, exclude_matcher(settings, write=False),
+            scan_jobs(settings), since
+        )
+
+        # determine the throughput in bytes per second
+        rates = []
+        bw_limit = bandwidth(settings)[0]
+        if bw_limit:
+            rate = bw_limit*1000/8
+            rates.append(rate)
+            output(f'bandwidth limit: {render_bytes(rate)}/s')
+        if settings.history_file.exists():
+            from .history import RunHistory, typical_throughput
+            with RunHistory(settings.history_file) as history:
+                runs = history.runs(
+                    settings.config_name, kinds=['full', 'incremental']
+                )
+            rate = typical_throughput(runs)
+            if rate:
+                rates.append(rate)
+                output(f'recent backups: {render_bytes(rate)}/s')
+
+        def render_estimate(kind, files, size):
+            if rates:
+                duration = render_duration(size/min(rates))
+            else:
+                duration = 'unknown duration'
+            output(f'{kind}: {files} files, {render_bytes(size)}, {duration}')
+
+        render_estimate('full', source.files, source.bytes)
+        if since:
+            render_estimate('incremental', source.changed_files, source.changed_bytes)
+        if not rates:
+            warn('throughput unknown, specify bw_limit or run a backup.')
+
+
+# Excludes command {{{1
+class Excludes(Command):
+    NAMES = 'excludes',
+    DESCRIPTION = 'list exclude rules before and after normalization'
+    USAGE = dedent("""
+        Usage:
+            embalm excludes
+
+        The exclude rules are expanded, duplicates are removed, and rules that
+        only exclude paths within a directory excluded by another rule are
+        dropped.  The remaining rules are given to duplicity in a file list.
+    """).strip()
+    LOCK_MODE = None
+    READ_ONLY = True
+
+    @classmethod
+    def run(cls, command, args, settings, options):
+        # read command line
+        docopt(cls.USAGE, argv=[command] + args)
+        from .excludes import normalize
+
+        given = list(settings.values('excludes'))
+        normalized, dropped = normalize(given)
+        highlight = Color('yellow')
+        output(f'given ({len(given)} rules):')
+        for each in given:
+            output(indent(str(each)))
+        output(f'normalized ({len(normalized)} rules):')
+        for each in normalized:
+            output(indent(each))
+        if dropped:
+            output(f'dropped ({len(dropped)} rules):')
+            for each, reason in dropped:
+                output(indent(f'{highlight(each)}: {reason}'))
+
+
+# Find command {{{1
+class Find(Command):
+    NAMES = 'find',
+    DESCRIPTION = 'list the backed up versions of matching paths'
+    USAGE = dedent("""
+        Usage:
+            embalm [options] find <pattern>
+
+        Options:
+            -r, --refresh              rebuild the manifest index from the remote
+
+        Lists every version of the paths that match a glob pattern found in
+        the backup sets.  The pattern is matched against the whole path
+        relative to the source directory, and * matches across directories.
+        For example:
+
+            embalm find 'src/*/settings.py'
+
+        For each matching path, the date of every backup set in which it
+        appeared (+), was modified (~), or disappeared (-) is given along with
+        its modification time.  Use the date with restore to recover that
+        version.
+
+        The file lists of the backup sets are fetched from the remote server
+        the first time they are needed and are kept in the manifest index, so
+        later searches are answered locally.
+    """).strip()
+    LOCK_MODE = 'shared'
+
+    @classmethod
+    def run(cls, command, args, settings, options):
+        # read command line
+        cmdline = docopt(cls.USAGE, argv=[command] + args)
+
+        from .index import ManifestIndex, render_mtime
+        with ManifestIndex(settings.manifest_index) as index:
+            if cmdline['--refresh']:
+                index.clear()
+            index_backup_sets(index, settings, options, cmdline['--refresh'])
+            path = None
+            for version in index.versions(cmdline['<pattern>']):
+                if version.path != path:
+                    path = version.path
+                    output(path)
+                date = arrow.get(version.time).to('local').format(
+                    'YYYY-MM-DD HH:mm:ss'
+                )
+                if version.status == '-':
+                    output(f'    {date} - removed')
+                else:
+                    output(
+                        f'    {date} {version.status}',
+                        render_mtime(version.mtime)
+                    )
 
 
 # Help {{{1
@@ -405,7 +1230,8 @@ class Help(Command):
             embalm help [<topic>]
             embalm h    [<topic>]
     """).strip()
-    REQUIRES_EXCLUSIVITY = False
+    LOCK_MODE = None
+    READ_ONLY = True
     EMBALM_DESCRIPTION = dedent("""
         Embalm is a simple command line utility to orchestrate backups. It is
         built on Duplicity, which is a powerful and flexible utility for
@@ -433,6 +1259,118 @@ class Help(Command):
         HelpMessage.show(cmdline['<topic>'], cls.EMBALM_DESCRIPTION)
 
 
+# History command {{{1
+class History(Command):
+    NAMES = 'history',
+    DESCRIPTION = 'summarize past runs'
+    USAGE = dedent("""
+        Usage:
+            embalm history [options]
+
+        Options:
+            -s, --since <date>    only include runs that started after date
+            -u, --until <date>    only include runs that started before date
+            -k, --kind <kind>     only include runs of a particular command,
+                                  such as full, incremental or restore
+            -t, --trend <period>  group runs by day, week or month to show
+                                  the trend [default: month]
+            -r, --runs            list the individual runs
+
+        Each backup, restore and manifest command is recorded in the run
+        history.  For each kind of command, the number of runs and failures,
+        the median (p50) and 95th percentile (p95) durations, and the
+        throughput are given, first overall and then for each period.
+        Backups skipped because nothing had changed are counted but do not
+        contribute to the durations or the throughput.
+
+        The dates may be given in the same forms as accepted by duplicity's
+        --time option, for example:
+
+            embalm history --since 6M
+    """).strip()
+    LOCK_MODE = None
+    READ_ONLY = True
+    PERIODS = dict(day='%Y-%m-%d', week='%G-W%V', month='%Y-%m')
+
+    @classmethod
+    def run(cls, command, args, settings, options):
+        # read command line
+        cmdline = docopt(cls.USAGE, argv=[command] + args)
+        from .history import RunHistory, duration, percentile, throughput
+        from .utilities import render_bytes, render_duration
+        since = cmdline['--since']
+        since = parse_time(since).timestamp() if since else None
+        until = cmdline['--until']
+        until = parse_time(until).timestamp() if until else None
+        kinds = [Command.find(cmdline['--kind'])[1]] if cmdline['--kind'] else None
+        period = cmdline['--trend']
+        if period not in cls.PERIODS:
+            raise Error(
+                'expected day, week, or month.', culprit=('--trend', period)
+            )
+
+        if not settings.history_file.exists():
+            output('no runs have been recorded.')
+            return
+        with RunHistory(settings.history_file) as history:
+            runs = history.runs(settings.config_name, since, until, kinds)
+
+        def render_time(when):
+            return arrow.get(when).to('local').format('YYYY-MM-DD HH:mm')
+
+        def render_rate(rate):
+            return f'{render_bytes(rate)}/s' if rate is not None else '-'
+
+        def summarize(runs):
+            failures = sum(1 for r in runs if r.status)
+            skipped = sum(1 for r in runs if r.skipped)
+            succeeded = [r for r in runs if not r.status and not r.skipped]
+            durations = [r.end - r.start for r in succeeded]
+            sent = [r for r in succeeded if r.bytes_sent is not None]
+            elapsed = sum(duration(r) for r in sent)
+            rate = sum(r.bytes_sent for r in sent)/elapsed if elapsed else None
+            fields = [f'{len(runs)} runs']
+            if failures:
+                fields.append(f'{failures} failed')
+            if skipped:
+                fields.append(f'{skipped} skipped')
+            if durations:
+                fields.append(f'p50 {render_duration(percentile(durations, 0.5))}')
+                fields.append(f'p95 {render_duration(percentile(durations, 0.95))}')
+            if rate is not None:
+                fields.append(render_rate(rate))
+            return ', '.join(fields)
+
+        if cmdline['--runs']:
+            for run in runs:
+                if run.status:
+                    status = f'failed ({run.status})'
+                else:
+                    status = 'skipped' if run.skipped else 'ok'
+                output(
+                    f'{render_time(run.start)} {run.kind:<12s}',
+                    f'{render_duration(run.end - run.start):>8s}',
+                    f'{render_rate(throughput(run)):>11s}',
+                    status,
+                )
+            if runs:
+                output()
+
+        by_kind = {}
+        for run in runs:
+            by_kind.setdefault(run.kind, []).append(run)
+        if not by_kind:
+            output('no runs found.')
+        for kind, runs_of_kind in sorted(by_kind.items()):
+            output(f'{kind}: {summarize(runs_of_kind)}')
+            by_period = {}
+            for run in runs_of_kind:
+                key = time.strftime(cls.PERIODS[period], time.localtime(run.start))
+                by_period.setdefault(key, []).append(run)
+            for key, runs_in_period in sorted(by_period.items()):
+                output(indent(f'{key}: {summarize(runs_in_period)}'))
+
+
 # Info command {{{1
 class Info(Command):
     NAMES = 'info',
@@ -441,7 +1379,8 @@ class Info(Command):
         Usage:
             embalm info
     """).strip()
-    REQUIRES_EXCLUSIVITY = False
+    LOCK_MODE = None
+    READ_ONLY = True
 
     @classmethod
     def run(cls, command, args, settings, options):
@@ -449,7 +1388,7 @@ class Info(Command):
         cmdline = docopt(cls.USAGE, argv=[command] + args)
         display(f'              config: {settings.config_name}')
         display(f'              source: {settings.src_dir}')
-        display(f'         destination: {settings.dest_server}:{settings.dest_dir}')
+        display(f'         destination: {settings.backend.describe()}')
         display(f'  settings directory: {settings.config_dir}')
         display(f'   working directory: {settings.working_dir}')
         display(f'   archive directory: {settings.archive_dir}')
@@ -468,6 +1407,7 @@ class Manifest(Command):
 
         Options:
             -d <date>, --date <date>   date of the desired version of paths
+            -r, --refresh              rebuild the manifest index from the remote
 
         Once a backup has been performed, you can list the files available in 
         your archive using:
@@ -486,26 +1426,29 @@ class Manifest(Command):
         followed by one of the following characters s (seconds), m (minutes), 
         h (hours), D (days), W (weeks), M (months), or Y (years). You can 
         combine several to get more resolution.
+
+        The manifest is answered from a local index that is updated after
+        every backup. If the index does not cover the requested date, the
+        listing is fetched from the remote server and added to the index.
+        Use --refresh to discard the index and rebuild it from the remote.
     """).strip()
-    REQUIRES_EXCLUSIVITY = True
+    LOCK_MODE = 'shared'
+    RECORD_RUNS = True
 
     @classmethod
     def run(cls, command, args, settings, options):
         # read command line
         cmdline = docopt(cls.USAGE, argv=[command] + args)
-        date = ['--time', cmdline['--date']] if cmdline['--date'] else []
 
-        # run duplicity
-        rm('duplicity.log')
-        cmd = (
-            f'duplicity list-current-files'.split()
-            + duplicity_options(settings, options)
-            + archive_dir_command(settings)
-            + sftp_command(settings)
-            + date
-            + [destination(settings)]
-        )
-        run_duplicity(cmd, settings, True)
+        from .index import ManifestIndex, render_entry
+        with ManifestIndex(settings.manifest_index) as index:
+            if cmdline['--refresh']:
+                index.clear()
+            snapshot = get_snapshot(
+                index, settings, options, cmdline['--date'], cmdline['--refresh']
+            )
+            for path, mtime in index.listing(snapshot):
+                output(render_entry(path, mtime))
 
 
 # Restore command {{{1
@@ -519,6 +1462,7 @@ class Restore(Command):
 
         Options:
             -d <date>, --date <date>   date of the desired version of paths
+            -s, --separately           run duplicity once for each path
 
         You restore a file or directory using:
 
@@ -537,10 +1481,15 @@ class Restore(Command):
 
             embalm --date 6M restore src/verif/av/manpages/settings.py
 
+        If you give several paths, they are all restored with a single run of
+        duplicity, so the backup volumes are only fetched and decrypted once.
+        Use --separately to instead run duplicity once for each path.
+
         Your restored files will be found in the working directory in
         {RESTORE_DIR}.
     """).strip()
-    REQUIRES_EXCLUSIVITY = True
+    LOCK_MODE = 'shared'
+    RECORD_RUNS = True
 
     @classmethod
     def run(cls, command, args, settings, options):
@@ -548,25 +1497,85 @@ class Restore(Command):
         cmdline = docopt(cls.USAGE, argv=[command] + args)
         paths = cmdline['<path>']
         date = ['--time', cmdline['--date']] if cmdline['--date'] else []
+        desired = {
+            path: to_path(settings.starting_dir, path).relative_to(settings.src_dir)
+            for path in paths
+        }
+
+        # each path is restored into the restore directory under its own name,
+        # so paths with the same name would overwrite each other
+        names = {}
+        for path in paths:
+            names.setdefault(desired[path].name, []).append(path)
+        for name, same in names.items():
+            if len(same) > 1:
+                raise Error(
+                    'these paths have the same name and would overwrite each',
+                    'other, restore them using separate commands:',
+                    ', '.join(same), culprit=name
+                )
 
         # run duplicity
         rm('duplicity.log')
         mkdir(settings.restore_dir)
+        if len(paths) == 1 or cmdline['--separately']:
+            for path in paths:
+                narrate('restoring:', path)
+                dest = to_path(settings.restore_dir, desired[path].name)
+
+                cmd = (
+                    f'duplicity restore --file-to-restore {desired[path]}'.split()
+                    + duplicity_options(settings, options)
+                    + archive_dir_command(settings)
+                    + backend_options(settings)
+                    + date
+                    + [destination(settings), dest]
+                )
+                run_duplicity(cmd, settings, 'narrate' in options)
+                output(f"restored as: {dest}", culprit=path)
+            return
+
+        # restore all of the paths in one pass into a staging directory, then
+        # move each into its place in the restore directory
+        staging = to_path(
+            settings.restore_dir, f'{RESTORE_STAGING_DIR}.{os.getpid()}'
+        )
+        rm(staging)
+        selection = []
         for path in paths:
-            desired = to_path(settings.starting_dir, path).relative_to(settings.src_dir)
-            narrate('restoring:', path)
-            dest = to_path(settings.restore_dir, desired.name)
+            selection.extend(['--include', str(to_path(staging, desired[path]))])
+        selection.extend(['--exclude', '**'])
+        narrate('restoring:', *paths)
+        cmd = (
+            f'duplicity restore'.split()
+            + duplicity_options(settings, options)
+            + archive_dir_command(settings)
+            + backend_options(settings)
+            + date
+            + selection
+            + [destination(settings), staging]
+        )
+        run_duplicity(cmd, settings, 'narrate' in options)
 
-            cmd = (
-                f'duplicity restore --file-to-restore {desired}'.split()
-                + duplicity_options(settings, options)
-                + archive_dir_command(settings)
-                + sftp_command(settings)
-                + date
-                + [destination(settings), dest]
-            )
-            run_duplicity(cmd, settings, 'narrate' in options)
+        restored = 0
+        restored_bytes = 0
+        for path in paths:
+            found = to_path(staging, desired[path])
+            if not found.exists() and not found.is_symlink():
+                warn('not found in backup.', culprit=path)
+                continue
+            dest = to_path(settings.restore_dir, desired[path].name)
+            rm(dest)
+            mv(found, dest)
+            restored += 1
+            restored_bytes += disk_usage(dest)
             output(f"restored as: {dest}", culprit=path)
+        rm(staging)
+        output(
+            f'{restored} of {len(paths)} paths restored,',
+            f'{restored_bytes} bytes on disk.'
+        )
+        return dict(files=restored)
 
 
 # Settings command {{{1
@@ -575,10 +1584,15 @@ class Settings(Command):
     DESCRIPTION = 'list settings of chosen configuration'
     USAGE = dedent("""
         Usage:
-            embalm settings
-            embalm s
+            embalm settings [--timing]
+            embalm s [--timing]
+
+        Options:
+            --timing   report time taken to read the settings with and without
+                       the cache
     """).strip()
-    REQUIRES_EXCLUSIVITY = False
+    LOCK_MODE = None
+    READ_ONLY = True
 
     @classmethod
     def run(cls, command, args, settings, options):
@@ -587,6 +1601,21 @@ class Settings(Command):
         highlight = Color('yellow')
         normal = Color('cyan')
 
+        if cmdline['--timing']:
+            from .settings import Settings as ConfigSettings
+
+            def time_reading(use_cache, repetitions=10):
+                start = time.perf_counter()
+                for i in range(repetitions):
+                    ConfigSettings(settings.config_name, None, use_cache=use_cache)
+                return 1000*(time.perf_counter() - start)/repetitions
+
+            cold = time_reading(False)
+            warm = time_reading(True)
+            output(f'  cold (cache not used): {cold:.2f} ms')
+            output(f'      warm (cache used): {warm:.2f} ms')
+            return
+
         for k, v in settings:
             key = f'{k:>22s}'
             key = normal(key) if k in KNOWN_SETTINGS else highlight(key)
@@ -601,7 +1630,8 @@ class Version(Command):
         Usage:
             embalm version
     """).strip()
-    REQUIRES_EXCLUSIVITY = False
+    LOCK_MODE = None
+    READ_ONLY = True
 
     @classmethod
     def run(cls, command, args, settings, options):
@@ -0,0 +1,205 @@
+# Excludes
+#
+# Normalizes the exclude patterns and writes them to a file list for duplicity.
+# Patterns are expanded, duplicates are removed, and patterns that can only
+# match paths within a directory excluded by another pattern are dropped. As
+# embalm only gives excludes, never includes, the order of the patterns does
+# not matter, and dropping a pattern that is covered by another does not
+# change what is backed up.
+
+# License {{{1
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+
+# Imports {{{1
+from .scanner import glob_to_regex
+from inform import narrate
+from shlib import to_path
+import hashlib
+import os
+import re
+
+# Globals {{{1
+WILDCARDS = re.compile(r'[*?\[]')
+
+# ancestors() {{{1
+def ancestors(pattern):
+    """The directories that contain every path matched by a pattern.
+
+    These are the leading components of the pattern that do not contain
+    wildcards. If the pattern contains no wildcards, it is included as well,
+    as it can only match itself.
+    """
+    components = pattern.rstrip('/').split('/')
+    for i in range(1, len(components)):
+        if WILDCARDS.search(components[i-1]):
+            return
+        if i > 1 or components[0]:
+            yield '/'.join(components[:i])
+    if not WILDCARDS.search(pattern):
+        yield pattern.rstrip('/')
+
+# Pattern class {{{1
+class Pattern:
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.dirs_only = pattern.endswith('/')
+        self.regex = re.compile(glob_to_regex(pattern.rstrip('/')))
+        self.literal = not WILDCARDS.search(pattern)
+        self.ancestors = list(ancestors(pattern))
+
+    def covers(self, other):
+        """Is every path matched by other within a path excluded by this pattern?
+
+        A pattern that only matches directories only covers the last ancestor
+        of a literal pattern if that pattern also only matches directories.
+        """
+        candidates = other.ancestors
+        if self.dirs_only and other.literal and not other.dirs_only:
+            candidates = candidates[:-1]
+        return any(self.regex.fullmatch(a) for a in candidates)
+
+# Coverage class {{{1
+class Coverage:
+    """Find the patterns that cover a pattern.
+
+    Comparing every pair of patterns is quadratic, which is slow for long
+    exclude lists. Instead, a literal pattern can only match a path equal to
+    itself, so the literal patterns are kept in a dictionary keyed by path.
+    A glob can only match paths below its leading literal directory, so the
+    globs are grouped by that directory, and each group is combined into one
+    regular expression that is only examined further if it matches.
+    """
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self.literals = {}
+        self.globs = {}
+        for i, pattern in enumerate(patterns):
+            if pattern.literal:
+                self.literals.setdefault(pattern.ancestors[-1], []).append(i)
+            else:
+                prefix = pattern.ancestors[-1] if pattern.ancestors else ''
+                self.globs.setdefault(prefix, []).append(i)
+        self.combined = {
+            prefix: re.compile('|'.join(
+                f'(?:{patterns[i].regex.pattern})' for i in indices
+            ))
+            for prefix, indices in self.globs.items()
+        }
+
+    def find(self, pattern):
+        "Returns the indices of the patterns that cover pattern, in order."
+        found = set()
+        candidates = pattern.ancestors
+        for n, candidate in enumerate(candidates):
+            # a pattern that only matches directories does not cover the
+            # last ancestor of a literal pattern that matches files too
+            last = pattern.literal and not pattern.dirs_only and n == len(candidates) - 1
+            for j in self.literals.get(candidate, []):
+                if not (last and self.patterns[j].dirs_only):
+                    found.add(j)
+            for prefix in [''] + candidates[:n]:
+                if prefix not in self.combined:
+                    continue
+                if not self.combined[prefix].fullmatch(candidate):
+                    continue
+                for j in self.globs[prefix]:
+                    other = self.patterns[j]
+                    if last and other.dirs_only:
+                        continue
+                    if other.regex.fullmatch(candidate):
+                        found.add(j)
+        return sorted(found)
+
+# normalize() {{{1
+def normalize(patterns):
+    """Normalize a list of exclude patterns.
+
+    Returns the list of patterns that are kept and a list of (pattern, reason)
+    pairs for those that were dropped.
+    """
+    kept = []
+    dropped = []
+    seen = set()
+    for pattern in patterns:
+        pattern = str(to_path(pattern)) + ('/' if str(pattern).endswith('/') else '')
+        if pattern in seen:
+            dropped.append((pattern, 'duplicate'))
+            continue
+        seen.add(pattern)
+        kept.append(pattern)
+
+    # drop the patterns that are covered by another pattern
+    compiled = [Pattern(p) for p in kept]
+    covering = Coverage(compiled)
+    normalized = []
+    for i, pattern in enumerate(compiled):
+        for j in covering.find(pattern):
+            if i == j:
+                continue
+            other = compiled[j]
+            # if two patterns cover each other, keep the first
+            if j > i and pattern.covers(other):
+                continue
+            dropped.append((pattern.pattern, f'covered by {other.pattern}'))
+            break
+        else:
+            normalized.append(pattern.pattern)
+    return normalized, dropped
+
+# signature() {{{1
+def signature(patterns):
+    "A digest of the patterns used to create an exclude file list."
+    digest = hashlib.sha1()
+    for pattern in patterns:
+        digest.update(str(pattern).encode('utf-8', 'surrogateescape') + b'\0')
+    return digest.hexdigest()
+
+# write_filelist() {{{1
+def write_filelist(patterns, path):
+    """Write the normalized patterns to an exclude file list.
+
+    The file is only rewritten if the patterns have changed since it was last
+    written, as recorded in a signature file that is kept alongside it.
+    Returns the normalized patterns.
+    """
+    patterns = list(patterns)
+    sig = signature(patterns)
+    sig_path = to_path(str(path) + '.sig')
+    try:
+        if sig_path.read_text().strip() == sig:
+            narrate('reusing exclude file list.')
+            return [
+                l[2:] for l in path.read_text(
+                    encoding='utf-8', errors='surrogateescape'
+                ).splitlines()
+            ]
+    except OSError:
+        pass
+    normalized, dropped = normalize(patterns)
+    narrate(
+        f'normalized {len(patterns)} exclude patterns to {len(normalized)}.'
+    )
+    # write to temporary files and rename them, as another process may be
+    # reading the file list
+    pid = os.getpid()
+    tmp_path = to_path(f'{path}.{pid}')
+    tmp_path.write_text(
+        ''.join(f'- {p}\n' for p in normalized),
+        encoding='utf-8', errors='surrogateescape'
+    )
+    os.replace(tmp_path, path)
+    tmp_path = to_path(f'{sig_path}.{pid}')
+    tmp_path.write_text(sig + '\n')
+    os.replace(tmp_path, sig_path)
+    return normalized
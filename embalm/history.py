@@ -0,0 +1,171 @@
+# Run History
+#
+# Keeps a record of each backup, restore and manifest command in an SQLite
+# database in the working directory. Rows are only ever added, so the history
+# can be used to follow how the duration and throughput of the backups change
+# over months.
+
+# License {{{1
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+
+# Imports {{{1
+from inform import Error
+from collections import namedtuple
+import math
+import sqlite3
+import statistics
+
+# Globals {{{1
+SCHEMA = '''
+    create table if not exists runs (
+        id integer primary key,
+        start real not null,
+        end real not null,
+        kind text not null,
+        config text not null,
+        status integer not null,
+        bytes_scanned integer,
+        bytes_sent integer,
+        bytes_received integer,
+        volumes integer,
+        files integer,
+        bw_limit real,
+        volsize integer,
+        asynchronous_upload integer,
+        concurrency integer,
+        cpu_seconds real,
+        duplicity_seconds real,
+        skipped integer
+    );
+    create index if not exists runs_by_start on runs (start);
+'''
+COLUMNS = (
+    'start end kind config status '
+    'bytes_scanned bytes_sent bytes_received volumes files bw_limit '
+    'volsize asynchronous_upload concurrency cpu_seconds duplicity_seconds '
+    'skipped'
+).split()
+Run = namedtuple('Run', COLUMNS)
+
+# percentile() {{{1
+def percentile(values, fraction):
+    "Returns the value at the given fraction of the sorted values (nearest rank)."
+    values = sorted(values)
+    if not values:
+        return None
+    rank = max(math.ceil(fraction*len(values)), 1)
+    return values[rank - 1]
+
+# duration() {{{1
+def duration(run):
+    """Seconds spent transferring the backup.
+
+    This is the elapsed time reported by duplicity, which excludes the scan,
+    the hooks and the bookkeeping done by embalm. The duration of the whole
+    command is used for runs that do not have it.
+    """
+    if run.duplicity_seconds:
+        return run.duplicity_seconds
+    return run.end - run.start
+
+# throughput() {{{1
+def throughput(run):
+    "Bytes sent per second, None if unknown."
+    seconds = duration(run)
+    if run.bytes_sent is None or seconds <= 0:
+        return None
+    return run.bytes_sent/seconds
+
+# typical_throughput() {{{1
+def typical_throughput(runs, count=10):
+    """Median throughput of the last count successful runs that sent data.
+
+    Returns None if there are no such runs.
+    """
+    rates = [
+        throughput(run) for run in runs if not run.status and not run.skipped
+    ]
+    rates = [rate for rate in rates if rate][-count:]
+    return statistics.median(rates) if rates else None
+
+# RunHistory class {{{1
+class RunHistory:
+    def __init__(self, path):
+        self.path = path
+
+    # enter {{{2
+    def __enter__(self):
+        try:
+            self.db = sqlite3.connect(str(self.path), timeout=60)
+            self.db.executescript(SCHEMA)
+            # add any columns missing from databases made by older versions
+            present = {row[1] for row in self.db.execute('pragma table_info(runs)')}
+            for column in COLUMNS:
+                if column not in present:
+                    self.db.execute(f'alter table runs add column {column}')
+        except sqlite3.Error as err:
+            raise Error(str(err), culprit=self.path)
+        return self
+
+    # exit {{{2
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.db.commit()
+        self.db.close()
+
+    # add() {{{2
+    def add(self, start, end, kind, config, status, values):
+        """Record a run.
+
+        values is a dictionary that may contain bytes_scanned, bytes_sent,
+        bytes_received, volumes, files, bw_limit (in kbps), and the options
+        chosen by the autotuner along with the CPU time used by duplicity and
+        the elapsed time it reported (volsize, asynchronous_upload,
+        concurrency, cpu_seconds, duplicity_seconds).  skipped is true for
+        backups that were skipped because nothing had changed.
+        """
+        row = dict(
+            start=start, end=end, kind=kind, config=config, status=status
+        )
+        row.update({k: values.get(k) for k in COLUMNS[5:]})
+        try:
+            self.db.execute(
+                f'insert into runs ({", ".join(COLUMNS)}) '
+                f'values ({", ".join("?" for c in COLUMNS)})',
+                [row[c] for c in COLUMNS]
+            )
+            self.db.commit()
+        except sqlite3.Error as err:
+            raise Error(str(err), culprit=self.path)
+
+    # runs() {{{2
+    def runs(self, config, since=None, until=None, kinds=None):
+        """Returns the runs of a configuration, oldest first.
+
+        since and until are given in seconds since the epoch and kinds is
+        a collection of command names.
+        """
+        query = f'select {", ".join(COLUMNS)} from runs where config = ?'
+        args = [config]
+        if since is not None:
+            query += ' and start >= ?'
+            args.append(since)
+        if until is not None:
+            query += ' and start < ?'
+            args.append(until)
+        if kinds:
+            query += f' and kind in ({", ".join("?" for k in kinds)})'
+            args.extend(kinds)
+        query += ' order by start'
+        return [Run(*row) for row in self.db.execute(query, args)]
@@ -0,0 +1,339 @@
+# Manifest Index
+#
+# Keeps a local copy of the file lists of the backup sets so that questions
+# about what is in the backups can be answered without contacting the remote
+# server. The index is an SQLite database in the working directory. Each
+# snapshot holds the output of duplicity list-current-files as of a particular
+# time; paths are stored once and shared between snapshots. The times of the
+# backup sets in the chain, as reported by duplicity collection-status, are
+# also kept.
+
+# License {{{1
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+
+# Imports {{{1
+from inform import Error, narrate
+from collections import namedtuple
+import re
+import sqlite3
+import time
+
+# Globals {{{1
+SCHEMA = '''
+    create table if not exists snapshots (
+        id integer primary key,
+        time real unique not null,
+        kind text not null
+    );
+    create table if not exists paths (
+        id integer primary key,
+        path text unique not null
+    );
+    create table if not exists entries (
+        snapshot integer not null references snapshots(id) on delete cascade,
+        path integer not null references paths(id),
+        mtime integer not null,
+        primary key (snapshot, path)
+    ) without rowid;
+    create table if not exists sets (
+        time real primary key,
+        kind text not null
+    );
+    create table if not exists meta (
+        key text primary key,
+        value
+    );
+'''
+LISTING_LINE = re.compile(
+    r'(\w{3} \w{3} [ \d]\d \d\d:\d\d:\d\d \d{4}) (.*)'
+)
+COLLECTION_STATUS_LINE = re.compile(
+    r'\s*(Full|Incremental)\s+(\w{3} \w{3} [ \d]\d \d\d:\d\d:\d\d \d{4})\s+\d+\s*'
+)
+Snapshot = namedtuple('Snapshot', 'id time kind')
+BackupSet = namedtuple('BackupSet', 'time kind')
+Version = namedtuple('Version', 'path time mtime status')
+
+# parse_listing() {{{1
+def parse_listing(lines):
+    """Extract paths and modification times from duplicity output.
+
+    Lines that do not look like entries in the output of duplicity
+    list-current-files (status messages and such) are ignored.
+    """
+    for line in lines:
+        match = LISTING_LINE.fullmatch(line.rstrip('\n'))
+        if match:
+            mtime, path = match.groups()
+            yield path, int(time.mktime(time.strptime(mtime)))
+
+# parse_collection_status() {{{1
+def parse_collection_status(lines):
+    "Extract the kind and time of each backup set from duplicity output."
+    for line in lines:
+        match = COLLECTION_STATUS_LINE.fullmatch(line.rstrip('\n'))
+        if match:
+            kind, when = match.groups()
+            yield BackupSet(time.mktime(time.strptime(when)), kind.lower())
+
+# render_mtime() {{{1
+def render_mtime(mtime):
+    "Render a modification time in the form used by duplicity."
+    return time.asctime(time.localtime(mtime))
+
+# render_entry() {{{1
+def render_entry(path, mtime):
+    "Render an entry in the same form used by duplicity list-current-files."
+    return f'{render_mtime(mtime)} {path}'
+
+# ManifestIndex class {{{1
+class ManifestIndex:
+    def __init__(self, path):
+        self.path = path
+
+    # enter {{{2
+    def __enter__(self):
+        try:
+            self.db = sqlite3.connect(str(self.path), timeout=60)
+            self.db.execute('pragma foreign_keys = on')
+            self.db.executescript(SCHEMA)
+        except sqlite3.Error as err:
+            raise Error(str(err), culprit=self.path)
+        return self
+
+    # exit {{{2
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.db.commit()
+        self.db.close()
+
+    # snapshots() {{{2
+    def snapshots(self):
+        "Returns all snapshots, oldest first."
+        rows = self.db.execute('select id, time, kind from snapshots order by time')
+        return [Snapshot(*row) for row in rows]
+
+    # find() {{{2
+    def find(self, when):
+        """Returns the most recent snapshot taken at or before when.
+
+        when is given in seconds since the epoch. None is returned if there is
+        no such snapshot.
+        """
+        row = self.db.execute(
+            'select id, time, kind from snapshots where time <= ? '
+            'order by time desc limit 1',
+            (when,)
+        ).fetchone()
+        return Snapshot(*row) if row else None
+
+    # add() {{{2
+    def add(self, when, kind, lines):
+        """Add a snapshot.
+
+        when is the time of the snapshot in seconds since the epoch, kind
+        describes how it was created, and lines is the output of duplicity
+        list-current-files. Any existing snapshot with the same time is
+        replaced.
+        """
+        snapshot = self.create(when, kind)
+        count = self.insert(snapshot, list(parse_listing(lines)))
+        self.db.commit()
+        narrate(f'indexed {count} paths.')
+        return Snapshot(snapshot, when, kind)
+
+    # update() {{{2
+    def update(self, base, when, kind, changes):
+        """Add a snapshot made by applying changes to an existing snapshot.
+
+        base is the snapshot the changes apply to, None for an empty one, and
+        changes is a list of (path, mtime) pairs, where mtime is None if the
+        path was deleted. Any existing snapshot with the same time is
+        replaced.
+        """
+        db = self.db
+        snapshot = self.create(when, kind)
+        if base:
+            db.execute(
+                'insert into entries (snapshot, path, mtime) '
+                'select ?, path, mtime from entries where snapshot = ?',
+                (snapshot, base.id)
+            )
+        db.executemany(
+            'delete from entries where snapshot = ? and '
+            'path = (select id from paths where path = ?)',
+            [(snapshot, path) for path, mtime in changes if mtime is None]
+        )
+        count = self.insert(
+            snapshot, [(p, m) for p, m in changes if m is not None]
+        )
+        db.commit()
+        narrate(f'indexed {count} changed paths.')
+        return Snapshot(snapshot, when, kind)
+
+    # create() {{{2
+    def create(self, when, kind):
+        "Create an empty snapshot, replacing any with the same time."
+        self.db.execute('delete from snapshots where time = ?', (when,))
+        return self.db.execute(
+            'insert into snapshots (time, kind) values (?, ?)', (when, kind)
+        ).lastrowid
+
+    # insert() {{{2
+    def insert(self, snapshot, entries):
+        "Add a list of (path, mtime) pairs to a snapshot, returns the count."
+        db = self.db
+        db.executemany(
+            'insert or ignore into paths (path) values (?)',
+            [(path,) for path, mtime in entries]
+        )
+        db.executemany(
+            'insert or replace into entries (snapshot, path, mtime) '
+            'select ?, id, ? from paths where path = ?',
+            [(snapshot, mtime, path) for path, mtime in entries]
+        )
+        return len(entries)
+
+    # listing() {{{2
+    def listing(self, snapshot):
+        "Iterate through the paths and modification times in a snapshot, sorted by path."
+        return self.db.execute(
+            'select paths.path, entries.mtime from entries '
+            'join paths on paths.id = entries.path '
+            'where entries.snapshot = ? order by paths.path',
+            (snapshot.id,)
+        )
+
+    # compare() {{{2
+    def compare(self, old, new):
+        """Compare two snapshots.
+
+        Yields (status, path, mtime) for each path that differs, where status
+        is '+' if the path was added, '-' if it was removed, and '~' if its
+        modification time changed.  The two listings are merged as they are
+        read, so neither is held in memory.
+        """
+        done = (None, None)
+        old_entries = self.listing(old)
+        new_entries = self.listing(new)
+        old_path, old_mtime = next(old_entries, done)
+        new_path, new_mtime = next(new_entries, done)
+        while old_path is not None or new_path is not None:
+            if new_path is None or (old_path is not None and old_path < new_path):
+                yield '-', old_path, old_mtime
+                old_path, old_mtime = next(old_entries, done)
+            elif old_path is None or new_path < old_path:
+                yield '+', new_path, new_mtime
+                new_path, new_mtime = next(new_entries, done)
+            else:
+                if old_mtime != new_mtime:
+                    yield '~', new_path, new_mtime
+                old_path, old_mtime = next(old_entries, done)
+                new_path, new_mtime = next(new_entries, done)
+
+    # backup_sets() {{{2
+    def backup_sets(self):
+        "Returns the backup sets recorded by set_backup_sets(), oldest first."
+        rows = self.db.execute('select time, kind from sets order by time')
+        return [BackupSet(*row) for row in rows]
+
+    # set_backup_sets() {{{2
+    def set_backup_sets(self, sets, when):
+        """Record the backup sets found on the remote.
+
+        when is the time the sets were fetched in seconds since the epoch.
+        """
+        self.db.execute('delete from sets')
+        self.db.executemany(
+            'insert or replace into sets (time, kind) values (?, ?)', sets
+        )
+        self.db.execute(
+            'insert or replace into meta (key, value) values (?, ?)',
+            ('sets_fetched', when)
+        )
+        self.db.commit()
+
+    # sets_fetched() {{{2
+    def sets_fetched(self):
+        "Time the backup sets were last recorded, 0 if never."
+        row = self.db.execute(
+            "select value from meta where key = 'sets_fetched'"
+        ).fetchone()
+        return row[0] if row else 0
+
+    # last_set() {{{2
+    def last_set(self, after, until):
+        """Time of the last backup set made in the interval (after, until].
+
+        Returns None if the recorded backup sets include none in the interval.
+        """
+        row = self.db.execute(
+            'select max(time) from sets where time > ? and time <= ?',
+            (after, until)
+        ).fetchone()
+        return row[0] if row else None
+
+    # covers() {{{2
+    def covers(self, start, end):
+        "Is there a snapshot taken in the interval [start, end)?"
+        return self.db.execute(
+            'select 1 from snapshots where time >= ? and time < ? limit 1',
+            (start, end)
+        ).fetchone() is not None
+
+    # versions() {{{2
+    def versions(self, pattern):
+        """Find the versions of the paths that match a glob pattern.
+
+        Yields a Version for each snapshot in which a matching path first
+        appears, has a new modification time, or disappears (status is '+',
+        '~', or '-').  The pattern is matched against the whole path and *
+        matches across directories.
+        """
+        times = [s.time for s in self.snapshots()]
+        position = {t: i for i, t in enumerate(times)}
+        rows = self.db.execute(
+            'select paths.path, snapshots.time, entries.mtime from paths '
+            'join entries on entries.path = paths.id '
+            'join snapshots on snapshots.id = entries.snapshot '
+            'where paths.path glob ? order by paths.path, snapshots.time',
+            (pattern,)
+        )
+        prev_path = prev_time = prev_mtime = None
+        for path, when, mtime in rows:
+            if path != prev_path:
+                if prev_path is not None and position[prev_time] + 1 < len(times):
+                    yield Version(
+                        prev_path, times[position[prev_time] + 1], None, '-'
+                    )
+                yield Version(path, when, mtime, '+')
+            elif position[when] != position[prev_time] + 1:
+                # path was missing from the intervening snapshots
+                yield Version(path, times[position[prev_time] + 1], None, '-')
+                yield Version(path, when, mtime, '+')
+            elif mtime != prev_mtime:
+                yield Version(path, when, mtime, '~')
+            prev_path, prev_time, prev_mtime = path, when, mtime
+        if prev_path is not None and position[prev_time] + 1 < len(times):
+            yield Version(prev_path, times[position[prev_time] + 1], None, '-')
+
+    # clear() {{{2
+    def clear(self):
+        "Remove all snapshots and backup sets."
+        self.db.execute('delete from entries')
+        self.db.execute('delete from snapshots')
+        self.db.execute('delete from paths')
+        self.db.execute('delete from sets')
+        self.db.execute('delete from meta')
+        self.db.commit()
@@ -0,0 +1,144 @@
+# Lock
+#
+# Advisory locking of the working directory using flock. Commands that modify
+# the backups take an exclusive lock, and commands that only read them take a
+# shared lock. The lock is released by the operating system if the process
+# dies, so a lock file left behind by a process that was killed is never
+# mistaken for a running process.
+
+# License {{{1
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+
+# Imports {{{1
+from inform import Error, display, narrate, os_error
+from textwrap import dedent
+import arrow
+import fcntl
+import os
+import re
+import time
+
+# Globals {{{1
+POLL_INTERVAL = 0.5
+
+# pid_is_running() {{{1
+def pid_is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+# Lock class {{{1
+class Lock:
+    """Lock a file.
+
+    path (path):
+        The lock file, created if it does not exist.
+    mode (str):
+        Either 'exclusive' or 'shared'.
+    wait (float):
+        Number of seconds to wait for the lock, 0 to wait indefinitely, or None
+        to fail at once if the lock is not available.
+    """
+    def __init__(self, path, mode='exclusive', wait=None):
+        self.path = path
+        self.mode = mode
+        self.wait = wait
+        self.fd = None
+
+    # holder() {{{2
+    def holder(self):
+        "Returns the process ID recorded in the lock file, None if there is none."
+        try:
+            match = re.search(r'pid = (\d+)', self.path.read_text())
+            return int(match.group(1)) if match else None
+        except OSError:
+            return None
+
+    # acquire() {{{2
+    def acquire(self):
+        """Acquire the lock.
+
+        Returns True if the lock was acquired and False if it is held by
+        another process and wait is None.  If the wait expires, Error is
+        raised.
+        """
+        try:
+            self.fd = os.open(str(self.path), os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError as err:
+            raise Error(os_error(err))
+        operation = fcntl.LOCK_EX if self.mode == 'exclusive' else fcntl.LOCK_SH
+        start = time.time()
+        waiting = False
+        while True:
+            try:
+                fcntl.flock(self.fd, operation | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if self.wait is None:
+                    self.close()
+                    return False
+                if self.wait and time.time() - start > self.wait:
+                    self.close()
+                    raise Error(
+                        f'timed out waiting for lock (see {self.path} for details).'
+                    )
+                if not waiting:
+                    display(f'waiting for process {self.holder()} to finish.')
+                    waiting = True
+                time.sleep(POLL_INTERVAL)
+
+        if self.mode == 'exclusive':
+            pid = self.holder()
+            if pid and pid != os.getpid() and not pid_is_running(pid):
+                narrate(f'ignoring stale lock left by process {pid}.')
+            os.ftruncate(self.fd, 0)
+            os.write(self.fd, dedent(f'''
+                started = {arrow.now()!s}
+                pid = {os.getpid()}
+            ''').lstrip().encode('utf-8'))
+        return True
+
+    # release() {{{2
+    def release(self):
+        if self.fd is None:
+            return
+        if self.mode == 'exclusive':
+            os.ftruncate(self.fd, 0)
+        self.close()
+
+    # close() {{{2
+    def close(self):
+        os.close(self.fd)
+        self.fd = None
+
+    # require() {{{2
+    def require(self):
+        "Acquire the lock, raising Error if it is held by another process."
+        if not self.acquire():
+            pid = self.holder()
+            running = f'currently running as process {pid}' if pid else 'currently running'
+            raise Error(f'{running} (see {self.path} for details).')
+
+    # enter {{{2
+    def __enter__(self):
+        self.require()
+        return self
+
+    # exit {{{2
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
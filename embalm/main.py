@@ -12,9 +12,16 @@ Usage:
 Options:
     -h, --help                        Output basic usage information.
     -c <cfgname>, --config <cfgname>  Specifies the configuration to use.
+    -a, --all                         Run command for every configuration.
+    --configs <cfgnames>              Run command for each of these configurations
+                                      (comma separated list).
+    -j <num>, --jobs <num>            Number of configurations to run at once
+                                      with --all or --configs.
     -n, --narrate                     Send embalm and Duplicity narration to stdout.
     -t, --trial-run                   Run Duplicity in dry run mode.
     -v, --verbose                     Make Duplicity more verbose.
+    -w <secs>, --wait <secs>          Wait for another embalm process to finish
+                                      rather than failing (0 waits indefinitely).
 
 Commands:
 {commands}
@@ -41,17 +48,67 @@ Use 'embalm help' for list of available help topics.
 # Imports {{{1
 from .command import Command
 from .settings import Settings, EMBALM_LOG_FILE
-from inform import Inform, Error, cull, fatal, display, terminate, os_error
+from inform import (
+    Inform, Error, cull, fatal, display, output, terminate, os_error
+)
 from docopt import docopt
+import sys
+
+# run_configs() {{{1
+def run_configs(configs, command, args, options, jobs, wait=None):
+    """Run a command for several configurations at once.
+
+    Each configuration is run in its own embalm process, so each keeps its own
+    lock and log file.  At most jobs processes are run at one time, and each
+    is given wait, the number of seconds to wait for the lock.  The output of
+    each process is shown as it is produced, each line prefixed by the name
+    of its configuration.  Returns the exit status of each configuration and
+    the time it took.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import subprocess
+    import threading
+    import time
+
+    showing = threading.Lock()
+
+    def run(config):
+        cmd = (
+            [sys.executable, '-m', 'embalm', '--config', config]
+            + ['--' + option for option in options]
+            + (['--wait', str(wait)] if wait is not None else [])
+            + cull([command])
+            + args
+        )
+        start = time.time()
+        with subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True
+        ) as process:
+            for line in process.stdout:
+                with showing:
+                    display(f'{config}: {line.rstrip()}')
+        return process.returncode, time.time() - start
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {c: executor.submit(run, c) for c in configs}
+        results = {c: f.result() for c, f in futures.items()}
+
+    output('\nconfig                 status   duration')
+    for config in configs:
+        status, duration = results[config]
+        output(f'{config:<20s} {status:>8d} {duration:>9.1f}s')
+    return results
 
 # Main {{{1
 def main():
     with Inform() as inform:
         # read command line
-        cmdline = docopt(
-            __doc__.format(commands=Command.summarize()),
-            options_first=True
-        )
+        cmdline = docopt(__doc__, options_first=True, help=False)
+        if cmdline['--help']:
+            # the command summaries are only generated when needed
+            output(__doc__.format(commands=Command.summarize()).strip())
+            terminate()
         config = cmdline['--config']
         command = cmdline['<command>']
         args = cmdline['<args>']
@@ -64,9 +121,35 @@ def main():
             inform.narrate = True
 
         try:
-            cmd, name = Command.find(command)
+            wait = cmdline['--wait']
+            try:
+                wait = float(wait) if wait else None
+            except ValueError:
+                raise Error('expected number.', culprit='--wait')
 
-            with Settings(config, cmd.REQUIRES_EXCLUSIVITY) as settings:
+            if cmdline['--all'] or cmdline['--configs']:
+                if config:
+                    raise Error('--config may not be combined with --all or --configs.')
+                available = Settings.configurations()
+                if cmdline['--all']:
+                    configs = list(available)
+                else:
+                    configs = cull(c.strip() for c in cmdline['--configs'].split(','))
+                    for each in configs:
+                        if each not in available:
+                            raise Error('unknown configuration.', culprit=each)
+                try:
+                    jobs = int(cmdline['--jobs'] or len(configs) or 1)
+                    if jobs < 1:
+                        raise ValueError
+                except ValueError:
+                    raise Error('expected a positive integer.', culprit='--jobs')
+                results = run_configs(configs, command, args, options, jobs, wait)
+                failed = any(status for status, duration in results.values())
+                terminate(1 if failed else None)
+
+            cmd, name = Command.find(command)
+            with Settings(config, cmd.LOCK_MODE, wait, cmd.READ_ONLY) as settings:
                 cmd.execute(name, args, settings, options)
 
         except KeyboardInterrupt:
@@ -0,0 +1,116 @@
+# Metrics
+#
+# Writes metrics describing the most recent run of a command in the text file
+# format read by the textfile collector of the Prometheus node exporter. One
+# file is written per configuration and command into the directory given by
+# the prometheus_dir setting. The file is replaced atomically so the collector
+# never sees a partially written file.
+
+# License {{{1
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+
+# Imports {{{1
+from .preferences import PROGRAM_NAME
+from .utilities import incr_date_files
+from inform import os_error, warn
+from shlib import to_path
+import arrow
+import os
+import re
+import time
+
+# Globals {{{1
+METRICS = dict(
+    last_success_timestamp_seconds = 'Time the command last completed successfully.',
+    last_run_timestamp_seconds = 'Time the command last completed.',
+    duration_seconds = 'Duration of the last run.',
+    exit_status = 'Exit status of the last run, 0 on success.',
+    bytes_sent = 'Bytes uploaded by the last run.',
+    volumes = 'Number of volumes written by the last run.',
+    files = 'Number of files processed by the last run.',
+    full_backup_age_seconds = 'Time since the last full backup.',
+    incremental_backup_age_seconds = 'Time since the last backup.',
+)
+
+# escape() {{{1
+def escape(value):
+    "Escape a label value."
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+# backup_age() {{{1
+def backup_age(paths, now):
+    "Seconds since the latest date recorded in the date files, None if unknown."
+    dates = []
+    for path in paths:
+        try:
+            dates.append(arrow.get(path.read_text()).timestamp())
+        except (OSError, arrow.parser.ParserError):
+            pass
+    return now - max(dates) if dates else None
+
+# write_metrics() {{{1
+def write_metrics(settings, command, start, status, values=None):
+    """Write the metrics for a run of a command.
+
+    start is the time the command started in seconds since the epoch, status
+    is its exit status, and values holds metrics particular to the command,
+    such as bytes_sent.  Does nothing unless prometheus_dir is specified.
+    """
+    directory = settings.value('prometheus_dir')
+    if not directory:
+        return
+    now = time.time()
+    name = f'{PROGRAM_NAME}-{settings.config_name}-{command}.prom'
+    path = to_path(directory, name)
+    labels = f'config="{escape(settings.config_name)}",command="{escape(command)}"'
+
+    metrics = dict(values or {})
+    metrics.update(
+        last_run_timestamp_seconds = now,
+        duration_seconds = now - start,
+        exit_status = status,
+        full_backup_age_seconds = backup_age([settings.full_date_file], now),
+        incremental_backup_age_seconds = backup_age(incr_date_files(settings), now),
+    )
+    if status == 0:
+        metrics['last_success_timestamp_seconds'] = now
+    else:
+        # keep the time of the last success from the previous file
+        try:
+            match = re.search(
+                r'^\w+_last_success_timestamp_seconds\{.*\} (\S+)$',
+                path.read_text(), re.M
+            )
+            if match:
+                metrics['last_success_timestamp_seconds'] = float(match.group(1))
+        except (OSError, ValueError):
+            pass
+
+    lines = []
+    for metric, description in METRICS.items():
+        value = metrics.get(metric)
+        if value is None:
+            continue
+        metric = f'{PROGRAM_NAME}_{metric}'
+        lines.append(f'# HELP {metric} {description}')
+        lines.append(f'# TYPE {metric} gauge')
+        lines.append(f'{metric}{{{labels}}} {value}')
+
+    # write to a temporary file in the same directory then rename it
+    tmp_path = to_path(directory, f'.{name}.{os.getpid()}')
+    try:
+        tmp_path.write_text('\n'.join(lines) + '\n')
+        os.replace(str(tmp_path), str(path))
+    except OSError as err:
+        warn('could not write metrics.', codicil=os_error(err))
@@ -17,7 +17,7 @@
 # along with this program.  If not, see http://www.gnu.org/licenses/.
 
 # Imports {{{1
-from appdirs import user_config_dir, user_data_dir
+from appdirs import user_cache_dir, user_config_dir, user_data_dir
 
 # Preferences {{{1
 PROGRAM_NAME = 'embalm'
@@ -27,15 +27,25 @@ INDENT = '    '
 
 CONFIG_DIR = user_config_dir(PROGRAM_NAME)
 DATA_DIR = user_data_dir(PROGRAM_NAME)
+CACHE_DIR = user_cache_dir(PROGRAM_NAME)
 ARCHIVE_DIR = 'archives'
 RESTORE_DIR = 'restored'
+RESTORE_STAGING_DIR = '.staging'
 
 SETTINGS_FILE = 'settings'
 EMBALM_LOG_FILE = '{prog_name}.log'
 DUPLICITY_LOG_FILE = 'duplicity.log'
 LOCK_FILE = 'lock'
+SSH_CONTROL_FILE = 'ssh-control'
+AGENT_SOCKET = 'agent'
+MANIFEST_INDEX_FILE = 'manifest.db'
+HISTORY_FILE = 'history.db'
 INCR_DATE_FILE = 'lastbackup_incr'
 FULL_DATE_FILE = 'lastbackup_full'
+SOURCE_STATE_FILE = 'lastbackup_state'
+UNCHANGED_DATE_FILE = 'lastbackup_unchanged'
+EXCLUDES_FILE = 'excludes'
+SCAN_JOBS = 4
 
 CONFIGS_SETTING = 'configuration_files'
 DEFAULT_CONFIG_SETTING = 'default_configuration'
@@ -44,8 +54,15 @@ WORKING_DIR_SETTING = 'working_dir'
 DEFAULT_WORKING_DIR = '{}/{{config_name}}'.format(DATA_DIR)
 
 KNOWN_SETTINGS = '''
+    asynchronous_upload
+    autotune
+    autotune_concurrency
     avendesora_account
+    backend
+    bw_adaptive_fraction
     bw_limit
+    bw_schedule
+    cache_settings
     config_name
     configuration_files
     default_configuration
@@ -57,11 +74,20 @@ KNOWN_SETTINGS = '''
     must_exist
     notifier
     notify
+    passphrase_ttl
+    prometheus_dir
     run_after_backup
     run_before_backup
+    scan_jobs
+    skip_unchanged
     src_dir
     ssh_backend_method
+    ssh_control_master
+    ssh_control_persist
     ssh_identity
+    update_date_when_unchanged
+    upload_concurrency
+    volsize
     working_dir
 '''.split()
     # Any setting found in the users settings files that is not found in
@@ -0,0 +1,284 @@
+# Progress
+#
+# Follows the log file written by duplicity while it runs, converts the log
+# records into events, and from those reports the progress of the backup.
+#
+# Duplicity's log file is machine readable. Each record starts with a line that
+# gives the level, a message code, and optionally some additional data. This
+# is followed by the message itself, with each line prefixed by '. '. For
+# example:
+#
+#     INFO 4 'home/ken/notes'
+#     . A home/ken/notes
+
+# License {{{1
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+
+# Imports {{{1
+from .utilities import render_bytes, render_duration
+from inform import log
+from collections import namedtuple
+import os
+import re
+import sys
+import threading
+import time
+
+# Globals {{{1
+RECORD_HEADER = re.compile(r'(DEBUG|INFO|NOTICE|WARNING|ERROR)(?: (\d+))?(?: (.*))?')
+FILE_CODES = {4: 'A', 5: 'M', 6: 'D'}
+UPLOAD_BEGIN_CODES = {12}
+    # asynchronous_upload_begin in duplicity's log.InfoCode
+UPLOAD_DONE_CODES = {13}
+    # asynchronous_upload_done in duplicity's log.InfoCode
+PROCESSED_VOLUME = re.compile(r'Processed volume (\d+)')
+WRITING_VOLUME = re.compile(r'Writing (\S+\.vol\d+\.difftar\S*)')
+PHASES = [
+    ('Synchronizing remote metadata', 'sync'),
+    ('Backup Statistics', 'finish'),
+]
+POLL_INTERVAL = 0.2
+UPDATE_INTERVAL = 0.5
+Event = namedtuple('Event', 'kind time data')
+    # kinds are:
+    #     file: data is (status, path), status is A, M, or D
+    #     volume: data is the number of the volume that was written
+    #     upload: data is the name of the volume being uploaded, if known
+    #     uploaded: data is None
+    #     phase: data is the name of the phase being entered
+    #     error: data is the message
+
+# LogParser class {{{1
+class LogParser:
+    """Convert the lines of a duplicity log file into events.
+
+    Lines are fed to the parser as they are read and the events are returned
+    as soon as the lines that describe them are available.
+
+    Duplicity only marks the start and end of an upload when uploading
+    asynchronously. Otherwise each volume is uploaded before it is reported
+    as processed, so the report marks the end of its upload.
+    """
+    def __init__(self, asynchronous=False):
+        self.asynchronous = asynchronous
+        self.level = None
+        self.code = None
+        self.extra = None
+        self.phase = None
+
+    # feed() {{{2
+    def feed(self, line):
+        "Process a line from the log, returns a list of events."
+        now = time.time()
+        line = line.rstrip('\n')
+        if line.startswith('. '):
+            return self.message(line[2:], now)
+        match = RECORD_HEADER.fullmatch(line)
+        if not match:
+            return []
+        level, code, extra = match.groups()
+        self.level = level
+        self.code = int(code) if code else None
+        self.extra = extra
+        events = []
+        if level == 'INFO' and self.code in UPLOAD_BEGIN_CODES:
+            events.append(Event('upload', now, None))
+        elif level == 'INFO' and self.code in UPLOAD_DONE_CODES:
+            events.append(Event('uploaded', now, None))
+        return events
+
+    # message() {{{2
+    def message(self, text, now):
+        events = []
+        if self.level == 'INFO' and self.code in FILE_CODES:
+            self.enter('transfer', now, events)
+            path = text[2:] if text[1:2] == ' ' else unquote(self.extra)
+            events.append(Event('file', now, (FILE_CODES[self.code], path)))
+            # only the first line of the message holds the path
+            self.code = None
+            return events
+        if self.level == 'ERROR':
+            events.append(Event('error', now, text))
+        match = WRITING_VOLUME.search(text)
+        if match:
+            events.append(Event('upload', now, match.group(1)))
+        match = PROCESSED_VOLUME.search(text)
+        if match:
+            self.enter('transfer', now, events)
+            if not self.asynchronous:
+                events.append(Event('uploaded', now, None))
+            events.append(Event('volume', now, int(match.group(1))))
+        for pattern, phase in PHASES:
+            if pattern in text:
+                self.enter(phase, now, events)
+        return events
+
+    # enter() {{{2
+    def enter(self, phase, now, events):
+        if phase != self.phase:
+            self.phase = phase
+            events.append(Event('phase', now, phase))
+
+# unquote() {{{1
+def unquote(text):
+    "Extract the quoted name from the data in a log record header."
+    if not text:
+        return text
+    if text.startswith("'"):
+        end = text.find("'", 1)
+        if end > 0:
+            return text[1:end]
+    return text.split(' ')[0]
+
+# Progress class {{{1
+class Progress:
+    """Accumulate the events from a duplicity log.
+
+    Keeps counts of files, bytes, and volumes, and the time spent in each
+    phase.
+    """
+    def __init__(self, src_dir=None):
+        self.src_dir = str(src_dir) if src_dir else None
+        self.start = time.time()
+        self.files = 0
+        self.bytes = 0
+        self.volume = 0
+        self.uploading = None
+        self.uploaded = 0
+        self.errors = 0
+        self.phases = [('start', self.start)]
+
+    # update() {{{2
+    def update(self, event):
+        if event.kind == 'file':
+            status, path = event.data
+            self.files += 1
+            if status != 'D' and self.src_dir:
+                try:
+                    self.bytes += os.lstat(os.path.join(self.src_dir, path)).st_size
+                except OSError:
+                    pass
+        elif event.kind == 'volume':
+            self.volume = event.data
+        elif event.kind == 'upload':
+            self.uploading = event.data or self.uploading
+        elif event.kind == 'uploaded':
+            self.uploading = None
+            self.uploaded += 1
+        elif event.kind == 'phase':
+            self.phases.append((event.data, event.time))
+        elif event.kind == 'error':
+            self.errors += 1
+
+    # rates() {{{2
+    def rates(self, now=None):
+        "Returns files per second and bytes per second since the start."
+        elapsed = max((now or time.time()) - self.start, 1e-3)
+        return self.files/elapsed, self.bytes/elapsed
+
+    # status() {{{2
+    def status(self):
+        "A one line summary of the progress so far."
+        files_per_sec, bytes_per_sec = self.rates()
+        return ', '.join([
+            f'{self.files} files',
+            f'{files_per_sec:.0f} files/s',
+            f'{render_bytes(bytes_per_sec)}/s',
+            f'volume {self.volume + 1}',
+        ])
+
+    # summary() {{{2
+    def summary(self, end=None):
+        "A summary of the time spent in each phase."
+        end = end or time.time()
+        lines = []
+        bounds = self.phases + [(None, end)]
+        for (phase, start), (_, stop) in zip(bounds, bounds[1:]):
+            lines.append(f'    {phase}: {render_duration(stop - start)}')
+        files_per_sec, bytes_per_sec = self.rates(end)
+        lines.append(
+            f'    total: {render_duration(end - self.start)}, '
+            f'{self.files} files, {render_bytes(self.bytes)}, '
+            f'{self.volume} volumes written, {self.uploaded} uploaded, '
+            f'{files_per_sec:.1f} files/s, {render_bytes(bytes_per_sec)}/s'
+        )
+        return '\n'.join(lines)
+
+# Monitor class {{{1
+class Monitor:
+    """Follow a duplicity log file in a background thread.
+
+    Use as a context manager around the running of duplicity. If show is
+    true, a progress line is kept up to date on the standard error.
+    asynchronous indicates whether duplicity uploads asynchronously. When done,
+    the time spent in each phase is written to the embalm log file.
+    """
+    def __init__(self, path, src_dir=None, show=False, asynchronous=False):
+        self.path = str(path)
+        self.show = show
+        self.parser = LogParser(asynchronous)
+        self.progress = Progress(src_dir)
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.follow, daemon=True)
+
+    # enter {{{2
+    def __enter__(self):
+        self.thread.start()
+        return self.progress
+
+    # exit {{{2
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.done.set()
+        self.thread.join()
+        if self.show:
+            sys.stderr.write('\r\033[K')
+            sys.stderr.flush()
+        log('duplicity progress:', self.progress.summary(), sep='\n')
+
+    # follow() {{{2
+    def follow(self):
+        # wait for duplicity to create the log file
+        while True:
+            finished = self.done.is_set()
+            try:
+                logfile = open(self.path, errors='replace')
+                break
+            except FileNotFoundError:
+                if finished:
+                    return
+                self.done.wait(POLL_INTERVAL)
+        last_update = 0
+        partial = ''
+        with logfile:
+            while True:
+                finished = self.done.is_set()
+                chunk = logfile.read()
+                if chunk:
+                    lines = (partial + chunk).split('\n')
+                    partial = lines.pop()
+                    for line in lines:
+                        for event in self.parser.feed(line):
+                            self.progress.update(event)
+                elif finished:
+                    # the file is complete, so the last line is too
+                    for event in self.parser.feed(partial):
+                        self.progress.update(event)
+                    return
+                else:
+                    self.done.wait(POLL_INTERVAL)
+                now = time.time()
+                if self.show and now - last_update > UPDATE_INTERVAL:
+                    sys.stderr.write('\r\033[K' + self.progress.status())
+                    sys.stderr.flush()
+                    last_update = now
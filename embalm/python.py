@@ -21,8 +21,79 @@
 
 
 # Imports {{{1
+from .preferences import CACHE_DIR
 from shlib import to_path, cp
 from inform import display, Error, narrate, os_error, full_stop
+from importlib.util import MAGIC_NUMBER
+import hashlib
+import marshal
+import os
+
+
+# Cache {{{1
+# Compiled code and settings are cached in CACHE_DIR using marshal. Each entry
+# is keyed by a name and holds the signatures of the files it was derived
+# from along with the value.  The entry is only used if every file still has
+# the same signature.  The Python magic number is included because the
+# marshal format is specific to the version of Python.
+def signature(path, contents):
+    "Returns the path, modification time, size and hash of a file."
+    stat = path.stat()
+    digest = hashlib.sha1(contents.encode('utf-8')).hexdigest()
+    return str(path), stat.st_mtime_ns, stat.st_size, digest
+
+def cache_path(kind, key):
+    name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return to_path(CACHE_DIR, f'{kind}-{name}')
+
+def read_cache(kind, key, check):
+    """Read value from cache.
+
+    check is a function that is passed the signatures saved with the value,
+    and returns True if they are still valid.  Returns None if there is no
+    valid entry.
+    """
+    try:
+        magic, signatures, value = marshal.loads(cache_path(kind, key).read_bytes())
+        if magic == MAGIC_NUMBER and check(signatures):
+            return value
+    except (OSError, ValueError, EOFError, TypeError):
+        pass
+
+def write_cache(kind, key, signatures, value):
+    """Write value to cache.
+
+    Returns False if value cannot be cached because it contains something
+    other than simple data.
+    """
+    try:
+        data = marshal.dumps((MAGIC_NUMBER, signatures, value))
+    except ValueError:
+        return False
+    path = cache_path(kind, key)
+    temp = to_path(f'{path}.{os.getpid()}')
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp.write_bytes(data)
+        os.replace(str(temp), str(path))
+    except OSError as err:
+        narrate('cannot write cache:', os_error(err))
+    return True
+
+def signatures_are_current(signatures):
+    "Are the signatures still valid for the files they describe?"
+    for path, mtime, size, digest in signatures:
+        path = to_path(path)
+        try:
+            stat = path.stat()
+            if (stat.st_mtime_ns, stat.st_size) != (mtime, size):
+                return False
+            contents = path.read_text(encoding='utf-8')
+        except OSError:
+            return False
+        if signature(path, contents)[3] != digest:
+            return False
+    return True
 
 
 # PythonFile class {{{1
@@ -66,27 +137,26 @@ class PythonFile:
         "Restores the backup copy of the file."
         cp(self.backup_path, self.path)
 
-    def run(self):
+    def run(self, use_cache=True):
         self.ActivePythonFile = self.path
         path = self.path
         narrate('reading:', path)
         try:
             self.code = self.read()
                 # need to save the code for the new command
+            self.signature = signature(path, self.code)
         except OSError as err:
             raise Error(os_error(err))
 
-        try:
-            compiled = compile(self.code, str(path), 'exec')
-        except SyntaxError as err:
-            culprit = (err.filename, err.lineno)
-            if err.text is None or err.offset is None:
-                raise Error(full_stop(err.msg), culprit=culprit)
-            else:
-                raise Error(
-                    err.msg + ':', err.text.rstrip(), (err.offset-1)*' ' + '^',
-                    culprit=culprit, sep='\n'
-                )
+        compiled = None
+        if use_cache:
+            compiled = read_cache(
+                'code', str(path), lambda sigs: sigs == [self.signature]
+            )
+        if compiled is None:
+            compiled = self.compile()
+            if use_cache:
+                write_cache('code', str(path), [self.signature], compiled)
 
         contents = {}
         try:
@@ -98,6 +168,20 @@ class PythonFile:
         # strip out keys that start with '__' and return them
         return {k: v for k, v in contents.items() if not k.startswith('__')}
 
+    def compile(self):
+        path = self.path
+        try:
+            return compile(self.code, str(path), 'exec')
+        except SyntaxError as err:
+            culprit = (err.filename, err.lineno)
+            if err.text is None or err.offset is None:
+                raise Error(full_stop(err.msg), culprit=culprit)
+            else:
+                raise Error(
+                    err.msg + ':', err.text.rstrip(), (err.offset-1)*' ' + '^',
+                    culprit=culprit, sep='\n'
+                )
+
     def create(self, contents):
         path = self.path
         try:
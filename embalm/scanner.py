@@ -0,0 +1,209 @@
+# Scanner
+#
+# Walks the source directory the way duplicity does, skipping excluded files
+# and directories, and summarizes what it finds. Used to determine whether
+# anything has changed since the last backup without running duplicity.
+
+# License {{{1
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+
+# Imports {{{1
+from inform import narrate, os_error, warn
+import hashlib
+import os
+import re
+import time
+
+# glob_to_regex() {{{1
+def glob_to_regex(pattern):
+    """Convert a duplicity glob pattern to a regular expression.
+
+    ** matches any string, * matches any string that does not contain /, ?
+    matches any single character other than /, and [...] matches a character
+    class.
+    """
+    regex = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**', i):
+            regex.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            regex.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            regex.append('[^/]')
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i+2:]:
+            end = pattern.index(']', i+2)
+            chars = pattern[i+1:end].replace('\\', '\\\\')
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            regex.append(f'[{chars}]')
+            i = end + 1
+        else:
+            regex.append(re.escape(pattern[i]))
+            i += 1
+    return ''.join(regex)
+
+# ExcludeMatcher class {{{1
+class ExcludeMatcher:
+    """Match paths against a list of duplicity exclude patterns.
+
+    The patterns are combined into one regular expression. A pattern that
+    ends in / only matches directories. As with duplicity, excluding a
+    directory excludes everything within it, so the walk should not descend
+    into an excluded directory.
+    """
+    def __init__(self, patterns):
+        patterns = [str(p) for p in patterns]
+        self.patterns = patterns
+        any_kind = [glob_to_regex(p) for p in patterns if not p.endswith('/')]
+        dirs_only = [glob_to_regex(p.rstrip('/')) for p in patterns if p.endswith('/')]
+        self.any_kind = self.compile(any_kind)
+        self.dirs_only = self.compile(dirs_only)
+
+    @staticmethod
+    def compile(regexes):
+        if not regexes:
+            return None
+        return re.compile('|'.join(f'(?:{r})' for r in regexes))
+
+    def __call__(self, path, is_dir=False):
+        "Returns True if path is excluded."
+        if self.any_kind and self.any_kind.fullmatch(path):
+            return True
+        if is_dir and self.dirs_only and self.dirs_only.fullmatch(path):
+            return True
+        return False
+
+# ScanResult class {{{1
+class ScanResult:
+    def __init__(self):
+        self.files = 0
+        self.dirs = 0
+        self.bytes = 0
+        self.excluded = 0
+        self.changed_files = 0
+        self.changed_bytes = 0
+        self.elapsed = 0
+        self.digest = None
+
+    def merge(self, other):
+        self.files += other.files
+        self.dirs += other.dirs
+        self.bytes += other.bytes
+        self.excluded += other.excluded
+        self.changed_files += other.changed_files
+        self.changed_bytes += other.changed_bytes
+
+    def __str__(self):
+        return (
+            f'{self.files} files, {self.dirs} directories, {self.bytes} bytes '
+            f'({self.excluded} excluded) '
+            f'scanned in {self.elapsed:.2f}s.'
+        )
+
+# visit() {{{1
+def visit(directory, matcher, result, digest, since=None):
+    """Examine the entries in a directory.
+
+    The size, modification and change times, inode, mode and owner of each
+    entry that is not excluded are added to the digest, as duplicity records
+    all of them, and the counts in result are updated.  Files
+    modified after since, if given, are counted as changed.  Returns the
+    subdirectories that should be descended, in sorted order.
+    """
+    try:
+        with os.scandir(directory) as entries:
+            entries = sorted(entries, key=lambda e: e.name)
+    except OSError as err:
+        warn(os_error(err))
+        return []
+    subdirs = []
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir(follow_symlinks=False)
+            stat = entry.stat(follow_symlinks=False)
+        except OSError as err:
+            warn(os_error(err))
+            continue
+        if matcher(entry.path, is_dir):
+            result.excluded += 1
+            continue
+        digest.update(
+            '\0'.join(str(v) for v in (
+                entry.path, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns,
+                stat.st_ino, stat.st_mode, stat.st_uid, stat.st_gid
+            )).encode('utf-8', 'surrogateescape') + b'\n'
+        )
+        if is_dir:
+            result.dirs += 1
+            subdirs.append(entry.path)
+        else:
+            result.files += 1
+            result.bytes += stat.st_size
+            if since is not None and stat.st_mtime > since:
+                result.changed_files += 1
+                result.changed_bytes += stat.st_size
+    return subdirs
+
+# walk() {{{1
+def walk(directory, matcher, since=None):
+    """Walk the tree below a directory, skipping excluded paths.
+
+    Returns a ScanResult for the tree, not including the directory itself.
+    """
+    result = ScanResult()
+    digest = hashlib.sha1()
+    pending = [directory]
+    while pending:
+        subdirs = visit(pending.pop(), matcher, result, digest, since)
+        # visit subdirectories in sorted order
+        pending.extend(reversed(subdirs))
+    result.digest = digest.hexdigest()
+    return result
+
+# scan() {{{1
+def scan(src_dir, matcher, jobs=1, since=None):
+    """Walk a directory tree, skipping excluded paths.
+
+    Returns a ScanResult whose digest is computed from the path, size,
+    modification and change times, inode, mode and owner of every file and
+    directory that is not excluded. If the digest is unchanged, then so is the tree.
+
+    The subtrees below the top-level directories are walked in parallel using
+    jobs threads.  Excluded directories are not descended, so excluded counts
+    only the excluded entries found in the directories that were descended.
+    The digest does not depend on jobs.
+    If since is given, files modified after that time, in seconds since the
+    epoch, are counted in changed_files and changed_bytes.
+    """
+    start = time.time()
+    result = ScanResult()
+    digest = hashlib.sha1()
+    subdirs = visit(str(src_dir), matcher, result, digest, since)
+    if jobs > 1 and len(subdirs) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            subtrees = list(executor.map(lambda d: walk(d, matcher, since), subdirs))
+    else:
+        subtrees = [walk(d, matcher, since) for d in subdirs]
+    for subtree in subtrees:
+        result.merge(subtree)
+        digest.update(subtree.digest.encode('ascii'))
+    result.digest = digest.hexdigest()
+    result.elapsed = time.time() - start
+    narrate('scan:', str(result))
+    return result
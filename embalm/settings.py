@@ -17,48 +17,118 @@
 # along with this program.  If not, see http://www.gnu.org/licenses/.
 
 # Imports {{{1
-from .collection import Collection
+from .collection import FrozenCollection
 from .preferences import (
     ARCHIVE_DIR,
     CONFIG_DIR,
+    CONFIGS_SETTING,
     DEFAULT_COMMAND,
     DEFAULT_WORKING_DIR,
     DUPLICITY_LOG_FILE,
     EMBALM_LOG_FILE,
+    EXCLUDES_FILE,
     FULL_DATE_FILE,
+    HISTORY_FILE,
     INCR_DATE_FILE,
     KNOWN_SETTINGS,
     LOCK_FILE,
+    MANIFEST_INDEX_FILE,
     PROGRAM_NAME,
     RESTORE_DIR,
     SETTINGS_FILE,
+    SOURCE_STATE_FILE,
+    UNCHANGED_DATE_FILE,
 )
-from .python import PythonFile
-from .utilities import gethostname, getusername
-from shlib import cd, mkdir, Run, to_path
+from .lock import Lock
+from .python import (
+    PythonFile, read_cache, signatures_are_current, write_cache
+)
+from .utilities import gethostname, getusername, link_or_copy
+from shlib import cd, mkdir, rm, Run, to_path
 from inform import (
     Error,
-    conjoin, full_stop, get_informer, is_str, narrate, warn,
+    conjoin, full_stop, get_informer, is_collection, is_str, narrate, warn,
 )
+from string import Formatter
 from textwrap import dedent
+from types import MappingProxyType
 from appdirs import user_config_dir
-import arrow
 import os
+import re
+import shutil
 
 
 # Utilities {{{1
 hostname = gethostname()
 username = getusername()
 
+# references() {{{2
+def references(text):
+    "Returns the names of the settings referred to in a string."
+    try:
+        return [
+            re.split(r'[.\[]', field)[0]
+            for literal, field, spec, conversion in Formatter().parse(text)
+            if field
+        ]
+    except ValueError:
+        return []
+
 # Settings class {{{1
 class Settings:
     # Constructor {{{2
-    def __init__(self, name=None, requires_exclusivity=True):
-        self.requires_exclusivity = requires_exclusivity
+    def __init__(
+        self, name=None, lock_mode='exclusive', wait=None, read_only=False,
+        use_cache=True
+    ):
+        self.lock_mode = lock_mode
+        self.wait = wait
+        self.read_only = read_only
+        self.use_cache = use_cache
+        self.lock = None
+        self.scratch_archive_dir = None
+        self.ssh_master = None
+        self.backend = None
+            # shadows the backend setting, use get('backend') for its value
         self.settings = {}
-        self.read(name)
+        self.signatures = []
+        if not self.read_cached(name):
+            self.read(name)
+            self.write_cached(name)
         self.check()
 
+    # read_cached() {{{2
+    def read_cached(self, name):
+        """Read the settings from the cache.
+
+        The merged settings are cached after they are read, and are used as
+        long as none of the files that contributed to them have changed.
+        Returns False if there is no valid cache entry.
+        """
+        if not self.use_cache:
+            return False
+        settings = read_cache('settings', str(name), signatures_are_current)
+        if settings is None:
+            return False
+        narrate('using cached settings.')
+        self.settings = settings
+        self.config_name = settings['config_name']
+        return True
+
+    # write_cached() {{{2
+    def write_cached(self, name):
+        """Save the settings to the cache.
+
+        The settings are only cached if they consist only of simple data (no
+        imported modules, functions, etc.), and if cache_settings is not set
+        to False.  Set cache_settings to False if your settings depend on
+        things other than the contents of the settings files, such as
+        environment variables.
+        """
+        if self.use_cache and self.settings.get('cache_settings', True):
+            if not write_cache('settings', str(name), self.signatures, self.settings):
+                narrate('settings not cached, they contain more than simple data.')
+
     # read() {{{2
     def read(self, name=None, path=None):
         """Recursively read configuration files.
@@ -74,16 +144,19 @@ class Settings:
         """
 
         if path:
-            settings = PythonFile(path).run()
+            pf = PythonFile(path)
+            settings = pf.run(self.use_cache)
+            self.signatures.append(pf.signature)
             parent = path.parent
-            includes = Collection(settings.get('include'))
+            includes = FrozenCollection(settings.get('include'))
         else:
             # this is generic settings file
             parent = CONFIG_DIR
             pf = PythonFile(parent, SETTINGS_FILE)
             settings_filename = pf.path
-            settings = pf.run()
-            configs = Collection(settings.get('configuration_files', ''))
+            settings = pf.run(self.use_cache)
+            self.signatures.append(pf.signature)
+            configs = FrozenCollection(settings.get('configuration_files', ''))
             default = settings.get('default_configuration')
             if not name:
                 name = default
@@ -104,7 +177,7 @@ class Settings:
                     )
             settings['config_name'] = config
             self.config_name = config
-            includes = Collection(settings.get('include'))
+            includes = FrozenCollection(settings.get('include'))
             includes = [config] + list(includes.values())
 
         self.settings.update(settings)
@@ -113,57 +186,126 @@ class Settings:
             path = to_path(parent, include)
             self.read(path=path)
 
+    # configurations() {{{2
+    @staticmethod
+    def configurations():
+        "Returns the names of the available configurations."
+        settings = PythonFile(CONFIG_DIR, SETTINGS_FILE).run()
+        return FrozenCollection(settings.get(CONFIGS_SETTING, ''))
+
     # check() {{{2
     def check(self):
-        # gather the string valued settings together (can be used by resolve)
-        self.str_settings = {k:v for k, v in self.settings.items() if is_str(v)}
-
         # complain about required settings that are missing
+        from .backends import get_backend
+        try:
+            self.backend = get_backend(self)
+        except Error as e:
+            self.fail(e.render())
         missing = []
-        for each in [
-            'dest_server', 'dest_dir', 'src_dir', 'ssh_backend_method',
-        ]:
+        for each in ['dest_dir', 'src_dir']:
             if not self.settings.get(each):
                 missing.append(each)
+        missing.extend(self.backend.check())
         if missing:
             missing = conjoin(missing)
             self.fail(f'{missing}: no value given.')
 
+        # resolve the string valued settings
+        self.resolve_all()
+
         # default the working_dir if it was not specified
         working_dir = self.settings.get('working_dir')
         if not working_dir:
             working_dir = self.resolve(DEFAULT_WORKING_DIR)
             self.settings['working_dir'] = working_dir
-            self.str_settings['working_dir'] = working_dir
-
-        # check the ssh_backend_method
-        if self.ssh_backend_method not in ['option', 'protocol']:
-            self.fail(
-                f'{self.ssh_backend_method}:',
-                'invalid value given for ssh_backend_method.',
+            self.resolved = MappingProxyType(
+                dict(self.resolved, working_dir=working_dir)
             )
 
         # add the working directory to excludes
-        excludes = self.settings.get('excludes', [])
+        excludes = list(FrozenCollection(self.settings.get('excludes')))
         excludes.append(self.working_dir)
         self.settings['excludes'] = excludes
 
+    # resolve_all() {{{2
+    def resolve_all(self):
+        """Resolve the string valued settings.
+
+        Settings may refer to other settings using {name}. Each string valued
+        setting is resolved once, after the settings it refers to, and the
+        results are kept in self.resolved, which is read only. A setting that
+        refers to a setting that does not exist is not an error unless it is
+        used (notifier, for example, refers to {msg}), so such errors are kept
+        in self.unresolvable and raised when the setting is accessed.
+        Circular references are reported immediately.
+        """
+        str_settings = {k: v for k, v in self.settings.items() if is_str(v)}
+        resolved = dict(
+            host_name=hostname, user_name=username, prog_name=PROGRAM_NAME
+        )
+        unresolvable = {}
+        active = []
+
+        def resolve(name):
+            if name in resolved or name in unresolvable:
+                return
+            if name in active:
+                cycle = active[active.index(name):] + [name]
+                raise Error(
+                    'circular reference.', culprit=' → '.join(cycle)
+                )
+            active.append(name)
+            value = str_settings[name]
+            for ref in references(value):
+                if ref in str_settings:
+                    resolve(ref)
+            try:
+                resolved[name] = value.format(**resolved)
+            except KeyError as e:
+                unresolvable[name] = unresolvable.get(
+                    e.args[0], Error('unknown setting.', culprit=(name, e.args[0]))
+                )
+            except (ValueError, IndexError, AttributeError) as e:
+                unresolvable[name] = Error(str(e), culprit=name)
+            active.pop()
+
+        for name in str_settings:
+            resolve(name)
+        self.resolved = MappingProxyType(resolved)
+        self.unresolvable = unresolvable
+        self.resolved_values = {}
+
     # resolve {{{2
     def resolve(self, value):
+        """Resolve a string that may refer to settings."""
         try:
-            resolved = value.format(
-                host_name=hostname, user_name=username, prog_name=PROGRAM_NAME,
-                **self.str_settings
-            )
+            return value.format(**self.resolved)
         except KeyError as e:
-            raise Error('unknown setting.', culprit=e)
-        if resolved != value:
-            resolved = self.resolve(resolved)
-        return resolved
+            name = e.args[0]
+            if name in self.unresolvable:
+                raise self.unresolvable[name]
+            raise Error('unknown setting.', culprit=name)
+
+    # snapshot {{{2
+    def snapshot(self):
+        """Returns all the settings, fully resolved, as a plain dictionary."""
+        snapshot = {}
+        for name, value in self.settings.items():
+            if is_str(value):
+                snapshot[name] = self.value(name)
+            elif is_collection(value):
+                snapshot[name] = list(self.values(name))
+            else:
+                snapshot[name] = value
+        return snapshot
 
     # handle errors {{{2
     def fail(self, *msg, comment=''):
         msg = full_stop(' '.join(str(m) for m in msg))
+        if self.backend:
+            destination = self.backend.describe()
+        else:
+            destination = f'{self.dest_server}:{self.dest_dir}'
         try:
             if self.notify:
                 Run(
@@ -173,7 +315,7 @@ class Settings:
                         {comment}
                         config = {self.config_name}
                         source = {hostname}:{self.src_dir}
-                        destination = {self.dest_server}:{self.dest_dir}
+                        destination = {destination}
                     ''').lstrip(),
                     modes='soeW'
                 )
@@ -197,13 +339,38 @@ class Settings:
     # get resolved value {{{2
     def value(self, name, default=''):
         """Gets fully resolved value of string setting."""
+        if name in self.unresolvable:
+            raise self.unresolvable[name]
+        if name in self.resolved and name in self.settings:
+            return self.resolved[name]
         return self.resolve(self.settings.get(name, default))
 
     # get resolved values {{{2
     def values(self, name):
-        """Iterate though fully resolved values of a collection setting."""
-        for value in Collection(self.settings.get(name)):
-            yield self.resolve(value)
+        """Iterate though fully resolved values of a collection setting.
+
+        The values are resolved when first requested and then remembered.
+        """
+        return iter(self.collection(name))
+
+    # get resolved collection {{{2
+    def collection(self, name):
+        """Returns fully resolved values of a collection setting.
+
+        The values are returned as a FrozenCollection, so membership tests are
+        fast.
+        """
+        if name not in self.resolved_values:
+            self.resolved_values[name] = FrozenCollection([
+                self.resolve(value)
+                for value in FrozenCollection(self.settings.get(name))
+            ])
+        return self.resolved_values[name]
+
+    # get raw value {{{2
+    def get(self, name, default=None):
+        """Gets value of setting as given, without resolution."""
+        return self.settings.get(name, default)
 
     # get attribute {{{2
     def __getattr__(self, name):
@@ -214,21 +381,22 @@ class Settings:
         for key in sorted(self.settings.keys()):
             yield key, self.settings[key]
 
-    # enter {{{2
-    def __enter__(self):
-        # change to working directory
+    # resolve_paths() {{{2
+    def resolve_paths(self):
+        """Resolve the paths of the directories and files used by embalm.
+
+        Nothing is created, so this may be used to find the files of a
+        configuration without otherwise affecting it.
+        """
         working_dir = self.value('working_dir')
         if not working_dir:
             working_dir = self.resolve(DEFAULT_WORKING_DIR)
         self.working_dir = to_path(working_dir)
-        mkdir(self.working_dir)
-        narrate('changing to working_dir:', working_dir)
-        self.starting_dir = cd(self.working_dir).starting_dir
 
         # resolve src and dest directories
-        src_dir = self.resolve(self.src_dir)
+        src_dir = self.value('src_dir')
         self.src_dir = to_path(src_dir)
-        dest_dir = self.resolve(self.dest_dir)
+        dest_dir = self.value('dest_dir')
         self.dest_dir = to_path(dest_dir)
 
         # resolve other files and directories
@@ -244,35 +412,120 @@ class Settings:
         full_date_file = self.resolve(FULL_DATE_FILE)
         self.full_date_file = to_path(working_dir, full_date_file)
 
+        unchanged_date_file = self.resolve(UNCHANGED_DATE_FILE)
+        self.unchanged_date_file = to_path(working_dir, unchanged_date_file)
+
         restore_dir = self.resolve(RESTORE_DIR)
         self.restore_dir = to_path(working_dir, restore_dir)
 
         archive_dir = self.resolve(ARCHIVE_DIR)
         self.archive_dir = to_path(working_dir, archive_dir)
 
+        manifest_index = self.resolve(MANIFEST_INDEX_FILE)
+        self.manifest_index = to_path(working_dir, manifest_index)
+
+        history_file = self.resolve(HISTORY_FILE)
+        self.history_file = to_path(working_dir, history_file)
+
+        source_state_file = self.resolve(SOURCE_STATE_FILE)
+        self.source_state_file = to_path(working_dir, source_state_file)
+
+        excludes_file = self.resolve(EXCLUDES_FILE)
+        self.excludes_file = to_path(working_dir, excludes_file)
+
+        lockfile = self.resolve(LOCK_FILE)
+        self.lockfile = to_path(working_dir, lockfile)
+
+    # enter {{{2
+    def __enter__(self):
+        self.resolve_paths()
+
+        # change to working directory
+        if self.read_only:
+            # do not create working directory or change into it
+            self.starting_dir = to_path(os.getcwd())
+        else:
+            mkdir(self.working_dir)
+            narrate('changing to working_dir:', self.working_dir)
+            self.starting_dir = cd(self.working_dir).starting_dir
+
         # perform locking
-        if self.requires_exclusivity:
-            # check for existance of lockfile
-            lockfile = self.lockfile = to_path(working_dir, LOCK_FILE)
-            if lockfile.exists():
-                raise Error(f'currently running (see {lockfile} for details).')
-
-            # create lockfile
-            now = arrow.now()
-            pid = os.getpid()
-            lockfile.write_text(dedent(f'''
-                started = {now!s}
-                pid = {pid}
-            ''').lstrip())
+        if self.lock_mode == 'exclusive':
+            self.lock = Lock(self.lockfile, 'exclusive', self.wait)
+            self.lock.require()
 
         # open logfile
-        get_informer().set_logfile(self.logfile)
+        if not self.read_only:
+            get_informer().set_logfile(self.logfile)
 
         return self
 
+    # get_archive_dir() {{{2
+    def get_archive_dir(self):
+        """Archive directory to be used by duplicity.
+
+        Commands that take a shared lock only read the backups, and are given
+        a private copy of the archive directory so they can run alongside each
+        other and alongside a backup that is already in progress. The copy is
+        made of hard links when it is first needed, and is removed on exit.
+
+        The copy is made without locking so that it never delays a backup.
+        Duplicity writes the files in the archive directory under a .part name
+        and renames them once complete, so only the complete files are copied.
+        A file that is removed or replaced while being copied is left out;
+        duplicity fetches any that are missing from the remote.
+        """
+        if self.lock_mode != 'shared':
+            return self.archive_dir
+        if not self.scratch_archive_dir:
+            scratch = to_path(f'{self.archive_dir}.{os.getpid()}')
+
+            def copy_complete(src, dest):
+                try:
+                    link_or_copy(src, dest)
+                    if os.stat(src).st_size == os.stat(dest).st_size:
+                        return
+                except FileNotFoundError:
+                    pass
+                if os.path.lexists(dest):
+                    os.unlink(dest)
+
+            rm(scratch)
+            if self.archive_dir.exists():
+                shutil.copytree(
+                    str(self.archive_dir), str(scratch),
+                    copy_function=copy_complete,
+                    ignore=shutil.ignore_patterns('lockfile*', '*.part'),
+                )
+            else:
+                mkdir(scratch)
+            self.scratch_archive_dir = scratch
+        return self.scratch_archive_dir
+
+    # get_ssh_options() {{{2
+    def get_ssh_options(self):
+        """Options that direct ssh and sftp to the shared master connection.
+
+        The master is started when first needed and stopped on exit, unless
+        ssh_control_persist is given. Returns an empty list if the master
+        is disabled or could not be started.
+        """
+        if not self.get('ssh_control_master', True) or self.read_only:
+            return []
+        if not self.backend.REMOTE:
+            return []
+        if self.ssh_master is None:
+            from .ssh import SSHMaster
+            self.ssh_master = SSHMaster(self)
+            self.ssh_master.start()
+        return self.ssh_master.options() if self.ssh_master.running else []
+
     # exit {{{2
     def __exit__(self, exc_type, exc_val, exc_tb):
-        # delete lockfile
-        if self.requires_exclusivity:
-            self.lockfile.unlink()
+        if self.ssh_master:
+            self.ssh_master.stop()
+        if self.scratch_archive_dir:
+            rm(self.scratch_archive_dir)
+        if self.lock:
+            self.lock.release()
 
@@ -0,0 +1,132 @@
+# SSH
+#
+# Manages an SSH master connection to the destination server so that each of
+# the sftp sessions started by duplicity share a single connection rather than
+# each performing its own key exchange and authentication. The control socket
+# is kept in the working directory.
+#
+# The master normally lives only as long as the embalm command that started
+# it. If ssh_control_persist is given, it is left running for that many
+# seconds after it was last used so that subsequent commands can use it too.
+# A master that is left running is only reused if it was started with the
+# same ssh-agent, as given by SSH_AUTH_SOCK.
+
+# License {{{1
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+
+# Imports {{{1
+from .preferences import SSH_CONTROL_FILE
+from inform import Error, narrate, warn
+from shlib import rm, to_path, Run
+import os
+
+# Globals {{{1
+MAX_SOCKET_PATH = 100
+    # Unix domain socket paths are limited to about 108 characters
+
+# SSHMaster class {{{1
+class SSHMaster:
+    def __init__(self, settings):
+        self.server = settings.value('dest_server')
+        self.control_path = to_path(settings.working_dir, SSH_CONTROL_FILE)
+        self.agent_file = to_path(f'{self.control_path}.agent')
+        self.persist = settings.get('ssh_control_persist')
+        identity = settings.value('ssh_identity')
+        self.identity = ['-i', str(to_path(identity))] if identity else []
+        self.owned = False
+        self.running = False
+
+    # ssh() {{{2
+    def ssh(self, *args, modes='sOEW'):
+        cmd = ['ssh', '-o', f'ControlPath={self.control_path}'] + list(args)
+        return Run(cmd + [self.server], modes=modes, log=False)
+
+    # check() {{{2
+    def check(self):
+        "Is a master running on the control socket?"
+        if not self.control_path.exists():
+            return False
+        try:
+            self.ssh('-O', 'check')
+            return True
+        except Error:
+            return False
+
+    # start() {{{2
+    def start(self):
+        """Start the master, or reuse one that was left running.
+
+        Returns False if a master could not be started, in which case each
+        session makes its own connection.
+        """
+        if len(str(self.control_path)) > MAX_SOCKET_PATH:
+            narrate('path to working directory too long for ssh control socket.')
+            return False
+        agent = os.environ.get('SSH_AUTH_SOCK', '')
+        if self.check():
+            try:
+                same_agent = self.agent_file.read_text() == agent
+            except OSError:
+                same_agent = False
+            if same_agent:
+                narrate('reusing ssh master connection.')
+                self.running = True
+                return True
+            narrate('ssh master was started with another agent, restarting it.')
+            self.exit()
+
+        rm(self.control_path)
+        persist = str(int(self.persist)) if self.persist else 'yes'
+        narrate('starting ssh master connection.')
+        try:
+            self.ssh(
+                '-o', 'ControlMaster=yes',
+                '-o', f'ControlPersist={persist}',
+                '-o', 'BatchMode=yes',
+                *self.identity, '-N'
+            )
+                # with ControlPersist the master detaches itself once it has
+                # connected, redirecting its output to /dev/null; -f would
+                # leave it holding the captured output open
+        except Error as err:
+            warn(
+                'could not start ssh master connection.',
+                codicil=err.get_message()
+            )
+            return False
+        self.agent_file.write_text(agent)
+        self.owned = True
+        self.running = True
+        return True
+
+    # options() {{{2
+    def options(self):
+        "Options for ssh or sftp that direct them to use the master."
+        return ['-o', f'ControlPath={self.control_path}', '-o', 'ControlMaster=no']
+
+    # exit() {{{2
+    def exit(self):
+        try:
+            self.ssh('-O', 'exit')
+        except Error:
+            pass
+        rm(self.control_path, self.agent_file)
+        self.running = False
+
+    # stop() {{{2
+    def stop(self):
+        "Stop the master if it was started by this command and is not to persist."
+        if self.owned and not self.persist:
+            narrate('stopping ssh master connection.')
+            self.exit()
@@ -16,11 +16,12 @@
 
 # Imports {{{1
 from shlib import Run, to_path
-from inform import is_str
-from pipes import quote
+from inform import Error, is_str
 import hashlib
 import os
+import re
 import shlex
+import shutil
 
 # gethostname {{{1
 # returns short version of the hostname (the hostname without any domain name)
@@ -48,6 +49,127 @@ def two_columns(col1, col2, width=16, indent=True):
     else:
         return '%s%-*s  %s' % (indent, width, col1, col2) 
 
+# disk_usage {{{1
+def disk_usage(path):
+    "Total size in bytes of a file or of all the files in a directory."
+    path = to_path(path)
+    if path.is_symlink() or not path.is_dir():
+        return path.lstat().st_size
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(str(path)):
+        for name in filenames:
+            total += os.lstat(os.path.join(dirpath, name)).st_size
+    return total
+
+# parse_time {{{1
+# Duplicity's time units, interval months and years are of fixed length.
+TIME_UNITS = dict(
+    s=1, m=60, h=3600, D=86400, W=7*86400, M=30*86400, Y=365*86400
+)
+def parse_time(spec, now=None):
+    """Convert a time given in the form accepted by duplicity's --time option.
+
+    Returns the time as an arrow object.  Accepts 'now', seconds since the
+    epoch, dates and date-times (2015-04-01, 2015/04/01, 04/01/2015,
+    2015-04-01T12:00:00+02:00) and intervals into the past (3D12h).
+    """
+    import arrow
+    now = now or arrow.now()
+    spec = spec.strip()
+    if spec == 'now':
+        return now
+    if spec.isdigit():
+        return arrow.get(int(spec)).to('local')
+    if re.fullmatch(r'(\d+[smhDWMY])+', spec):
+        seconds = sum(
+            int(num)*TIME_UNITS[unit]
+            for num, unit in re.findall(r'(\d+)([smhDWMY])', spec)
+        )
+        return now.shift(seconds=-seconds)
+    try:
+        date = arrow.get(spec)
+        if not re.search(r'(Z|[+-]\d\d:?\d\d)$', spec):
+            date = date.replace(tzinfo='local')
+        return date
+    except (arrow.parser.ParserError, ValueError):
+        pass
+    for fmt in ['YYYY/MM/DD', 'MM/DD/YYYY', 'MM-DD-YYYY']:
+        try:
+            return arrow.get(spec, fmt, tzinfo='local')
+        except (arrow.parser.ParserError, ValueError):
+            pass
+    raise Error('invalid date.', culprit=spec)
+
+# render_bytes {{{1
+def render_bytes(num):
+    "Render a number of bytes using SI prefixes."
+    for prefix in ['', 'k', 'M', 'G', 'T']:
+        if abs(num) < 1000:
+            break
+        num /= 1000
+    return f'{num:.0f} {prefix}B' if not prefix else f'{num:.1f} {prefix}B'
+
+# render_duration {{{1
+def render_duration(seconds):
+    "Render a duration given in seconds in hours, minutes and seconds."
+    if seconds < 10:
+        return f'{seconds:.1f}s'
+    seconds = int(round(seconds))
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return f'{hours}h {minutes:02d}m'
+    if minutes:
+        return f'{minutes}m {seconds:02d}s'
+    return f'{seconds}s'
+
+# incr_date_files {{{1
+def incr_date_files(settings):
+    """The date files that show when the incremental backups were last current.
+
+    This is the date of the last incremental backup and, unless
+    update_date_when_unchanged is False, the date of the last backup that was
+    skipped because nothing had changed.
+    """
+    files = [settings.incr_date_file]
+    if settings.get('update_date_when_unchanged', True):
+        files.append(settings.unchanged_date_file)
+    return files
+
+# read_statistics {{{1
+STATISTICS_LINE = re.compile(r'\. (\w+) (-?[\d.]+)(?: \(.*\))?')
+def read_statistics(path):
+    """Read the backup statistics from a duplicity log file.
+
+    Returns a dictionary that maps the name of each statistic (ElapsedTime,
+    SourceFileSize, TotalDestinationSizeChange, etc.) to its value. The
+    dictionary is empty if the log contains no statistics.
+    """
+    stats = {}
+    try:
+        lines = to_path(path).read_text(errors='replace').splitlines()
+    except OSError:
+        return stats
+    in_stats = False
+    for line in lines:
+        if 'Backup Statistics' in line:
+            in_stats = True
+        elif in_stats:
+            match = STATISTICS_LINE.fullmatch(line.strip())
+            if match:
+                stats[match.group(1)] = float(match.group(2))
+            elif line.startswith('. ---'):
+                in_stats = False
+    return stats
+
+# link_or_copy {{{1
+def link_or_copy(src, dest):
+    "Hard link a file, copy it if a link cannot be made."
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
 # error_source {{{1
 def error_source():
     """Source of error
@@ -75,6 +197,8 @@ def error_source():
 
 # render_command {{{1
 def render_command(cmd, option_args=True):
+    from pipes import quote
+
     if is_str(cmd):
         cmd = shlex.split(cmd)
     else:
@@ -89,10 +213,16 @@ def render_command(cmd, option_args=True):
             '--archive-dir': 1,
             '--name': 1,
             '--sftp-command': 1,
+            '--rsync-options': 1,
             '--file-to-restore': 1,
             '--ssh-backend': 1,
             '--exclude': 1,
+            '--exclude-filelist': 1,
+            '--exclude-globbing-filelist': 1,
+            '--include': 1,
             '--time': 1,
+            '--volsize': 1,
+            '--concurrency': 1,
         }
         option_args = duplicity_option_args
 
@@ -0,0 +1,84 @@
+# Watch
+#
+# Waits for files to change. Uses inotify if the inotify_simple package is
+# available, otherwise falls back to periodically checking the modification
+# times of the files.
+
+# License {{{1
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+
+# Imports {{{1
+from inform import narrate
+import time
+
+# Globals {{{1
+POLL_INTERVAL = 5
+
+# FileWatcher class {{{1
+class FileWatcher:
+    def __init__(self, paths):
+        self.paths = paths
+        self.inotify = None
+        try:
+            from inotify_simple import INotify, flags
+            inotify = INotify()
+            mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE | flags.DELETE
+            for directory in {p.parent for p in paths}:
+                inotify.add_watch(str(directory), mask)
+            self.inotify = inotify
+            narrate('watching with inotify.')
+        except ImportError:
+            narrate('inotify_simple not available, polling.')
+        except OSError as err:
+            # directory may not exist yet
+            narrate('cannot use inotify, polling:', str(err))
+        self.signature = self.get_signature()
+
+    # get_signature() {{{2
+    def get_signature(self):
+        signature = []
+        for path in self.paths:
+            try:
+                stat = path.stat()
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                signature.append(None)
+        return signature
+
+    # wait() {{{2
+    def wait(self, timeout):
+        """Wait until one of the files changes or timeout seconds pass.
+
+        Returns True if a file changed.
+        """
+        if self.inotify:
+            names = {p.name for p in self.paths}
+            deadline = time.time() + timeout
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                events = self.inotify.read(timeout=int(1000*remaining))
+                if any(event.name in names for event in events):
+                    self.signature = self.get_signature()
+                    return True
+
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            time.sleep(min(POLL_INTERVAL, max(deadline - time.time(), 0)))
+            signature = self.get_signature()
+            if signature != self.signature:
+                self.signature = signature
+                return True
+        return False